@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import argparse
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import data
+
+storeDirectory = 'art'
+_STALE_TEMPORARY_AGE = 24 * 3600
+
+class ArtStore(object):
+	"""Content-addressed store of art files in a library's state directory.
+
+	Objects are named after the SHA-256 of their content. URLs map to objects through symlinks named after the SHA-256 of the URL, and
+	art files in context directories are hardlinks to objects, so an object with a single link is referenced by nothing."""
+
+	_INSTANCES = {}
+	_INSTANCES_LOCK = threading.Lock()
+
+	@classmethod
+	def ForRoot(cls, root):
+		"""Returns the ArtStore in the state directory of the library at root, without reading its .root file (see data.SidecarCache.ForRoot)."""
+		with cls._INSTANCES_LOCK:
+			store = cls._INSTANCES.get(root)
+			if store is None:
+				store = cls._INSTANCES[root] = cls(data.statePath(root, storeDirectory))
+			return store
+
+	def __init__(self, path):
+		self._path = path
+		self._lock = threading.Lock()
+		self._urlLocks = {}
+		for d in (self.objects_path, self.urls_path, self.temporary_path):
+			os.makedirs(d, exist_ok=True)
+
+	@property
+	def path(self):
+		return self._path
+	@property
+	def objects_path(self):
+		return os.path.join(self.path, 'objects')
+	@property
+	def urls_path(self):
+		return os.path.join(self.path, 'urls')
+	@property
+	def temporary_path(self):
+		return os.path.join(self.path, 'tmp')
+
+	def _URLPath(self, url):
+		return os.path.join(self.urls_path, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+	def URLLock(self, url):
+		"""Returns a lock to hold while fetching url, so that concurrent grabs of the same URL download it once."""
+		with self._lock:
+			return self._urlLocks.setdefault(url, threading.Lock())
+
+	def Lookup(self, url):
+		"""Returns the path of the object previously stored for url, or None."""
+		path = self._URLPath(url)
+		if not os.path.exists(path): # Also catches dangling symlinks.
+			return None
+		return os.path.realpath(path)
+
+	def Add(self, temporary, digest, extension, url=None):
+		"""Moves the file at temporary into the store, unless an object with the same content already exists. Returns the object path."""
+		directory = os.path.join(self.objects_path, digest[:2])
+		os.makedirs(directory, exist_ok=True)
+		objectPath = os.path.join(directory, '%s.%s' % (digest, extension))
+		if os.path.exists(objectPath):
+			os.remove(temporary)
+		else:
+			os.replace(temporary, objectPath)
+		if url is not None:
+			urlPath = self._URLPath(url)
+			link = urlPath + '.tmp-%d-%d' % (os.getpid(), threading.get_ident())
+			os.symlink(os.path.relpath(objectPath, os.path.dirname(urlPath)), link)
+			os.replace(link, urlPath)
+		return objectPath
+
+	def LinkTo(self, objectPath, target):
+		"""Atomically makes target a hardlink to objectPath, or a copy if they are on different filesystems."""
+		handle, temporary = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.%s.' % (os.path.basename(target),), suffix='.part')
+		os.close(handle)
+		os.remove(temporary)
+		try:
+			os.link(objectPath, temporary)
+		except OSError as e:
+			if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+				raise
+			shutil.copyfile(objectPath, temporary)
+		os.replace(temporary, target)
+
+	def GarbageCollect(self):
+		"""Removes objects no art file links to any more, URL mappings to them, and leftover temporary files. Returns (objects, bytes) removed."""
+		removed = 0
+		removedBytes = 0
+		for directory, _, files in os.walk(self.objects_path):
+			for f in files:
+				path = os.path.join(directory, f)
+				stat = os.stat(path)
+				if stat.st_nlink == 1:
+					print('rm', path)
+					os.remove(path)
+					removed += 1
+					removedBytes += stat.st_size
+		for f in os.listdir(self.urls_path):
+			path = os.path.join(self.urls_path, f)
+			if not os.path.exists(path):
+				os.remove(path)
+		for f in os.listdir(self.temporary_path):
+			path = os.path.join(self.temporary_path, f)
+			if os.stat(path).st_mtime < time.time() - _STALE_TEMPORARY_AGE: # Newer ones may belong to a grab in progress.
+				os.remove(path)
+		return removed, removedBytes
+
+	def __str__(self):
+		return 'ArtStore<%s>' % (self.path,)
+
+def ForContext(context):
+	"""Returns the ArtStore of the library context belongs to, or None if it is not in a library."""
+	root = data.findRoot(context.path)
+	if root is None:
+		return None
+	return ArtStore.ForRoot(root)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Maintain the content-addressed art store of media libraries.')
+	parser.add_argument('command', choices=('gc',))
+	parser.add_argument('paths', nargs='+', help='Paths inside media libraries.')
+	args = parser.parse_args()
+	for path in args.paths:
+		root = data.findRoot(os.path.abspath(path))
+		if root is None:
+			print('Warning: Skipping', path, 'as it is not in a media library.')
+			continue
+		store = ArtStore.ForRoot(root)
+		removed, removedBytes = store.GarbageCollect()
+		print('Removed %d unreferenced objects (%d bytes) from %s.' % (removed, removedBytes, store))
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of episode number guessing: one GuessEpisodeNumber call per file versus one GuessEpisodeNumbers call per season.
+# Usage: benchmark-episodes.py [episode count...]
+
+import random
+import sys
+import timeit
+import data
+
+_RELEASE_TEMPLATE = '[Some-Long-Release-Group] Show Name With A Fairly Long Title S2 - %0{}d (BD 1920x1080 x264 10-bit FLAC) [%08X]' + data.mediaExtension
+
+def SeasonFilenames(count):
+	rng = random.Random(count)
+	template = _RELEASE_TEMPLATE.format(max(2, len(str(count))))
+	return [template % (i, rng.getrandbits(32)) for i in range(1, count + 1)]
+
+def Benchmark(count, repeat=5):
+	filenames = SeasonFilenames(count)
+	single = min(timeit.repeat(lambda: [data.Episode.GuessEpisodeNumber(f) for f in filenames], number=1, repeat=repeat))
+	batch = min(timeit.repeat(lambda: data.Episode.GuessEpisodeNumbers(filenames), number=1, repeat=repeat))
+	return single, batch
+
+if __name__ == '__main__':
+	counts = [int(c) for c in sys.argv[1:]] or [12, 26, 100, 500]
+	print('%8s %14s %14s %8s' % ('episodes', 'per-file (ms)', 'batch (ms)', 'speedup'))
+	for count in counts:
+		single, batch = Benchmark(count)
+		print('%8d %14.3f %14.3f %7.1fx' % (count, single * 1000, batch * 1000, single / batch))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# Startup benchmark: import time of data and of the tools run from cron, as reported by python -X importtime, with the slowest imports.
+# Usage: benchmark-startup.py [--top N] [--repeat N] [module...]
+
+import argparse
+import os
+import subprocess
+import sys
+
+_DEFAULT_MODULES = ('data', 'mkreflection', 'update-kodi', 'verify-art')
+
+def ImportTimes(module):
+	"""Imports module in a fresh interpreter. Returns its cumulative import time and a list of (time, name) of the modules it imported
+	directly, both in microseconds. Modules already imported during interpreter startup are not counted."""
+	result = subprocess.run(
+		[sys.executable, '-X', 'importtime', '-c', '__import__(%r)' % (module,)],
+		cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+	)
+	entries = []
+	for line in result.stderr.splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		_, cumulative, name = line[len('import time:'):].split('|')
+		depth = (len(name) - len(name.lstrip()) - 1) // 2
+		entries.append((depth, name.strip(), int(cumulative)))
+	# Entries are printed as imports complete, so a module's dependencies are the deeper entries right before it.
+	total = 0
+	dependencies = []
+	for i, (depth, name, cumulative) in enumerate(entries):
+		if depth == 0 and name == module:
+			total = cumulative
+			for depth, name, cumulative in reversed(entries[:i]):
+				if depth == 0:
+					break
+				if depth == 1:
+					dependencies.append((cumulative, name))
+			break
+	return total, sorted(dependencies, reverse=True)
+
+def Benchmark(module, repeat=5):
+	"""Returns the import times of the fastest of repeat runs."""
+	return min((ImportTimes(module) for _ in range(repeat)), key=lambda times: times[0])
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Measure the import time of modules and tools.')
+	parser.add_argument('--top', type=int, default=5, help='Number of slowest imports to list per module.')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('modules', nargs='*', default=_DEFAULT_MODULES)
+	args = parser.parse_args()
+	for module in args.modules:
+		total, dependencies = Benchmark(module, repeat=args.repeat)
+		print('%-24s %8.1f ms' % (module, total / 1000))
+		for t, name in dependencies[:args.top]:
+			print('  %-22s %8.1f ms' % (name, t / 1000))
@@ -1,16 +1,91 @@
+import atexit
+import concurrent.futures
+import hashlib
+import html.parser
+import json
 import math
 import os
+import pickle
 import re
+import stat
+import tempfile
+import threading
 import urllib.parse
-import sys
 
-import bs4
-import requests
 import yaml
 
-# TVDB API
-sys.path.append(os.path.join(os.path.dirname(__file__), 'submodules/tvdb_api'))
-import tvdb_api
+import httpclient
+import tvdbcache
+import webcache
+
+class _StopScan(Exception):
+	pass
+
+class _SearchScanner(html.parser.HTMLParser):
+	"""Streams through a search results page for its first match, without building a document tree. Subclasses set match and raise
+	_StopScan when they find it, so the rest of the page is neither parsed nor downloaded."""
+
+	def __init__(self):
+		super(_SearchScanner, self).__init__()
+		self.match = None
+
+	@classmethod
+	def Scan(cls, response, *args):
+		scanner = cls(*args)
+		if response.encoding is None:
+			response.encoding = 'utf-8'
+		try:
+			for chunk in response.iter_content(chunk_size=16 * 1024, decode_unicode=True):
+				scanner.feed(chunk)
+			scanner.close()
+		except _StopScan:
+			pass
+		finally:
+			response.close()
+		return scanner.match
+
+class _AnchorScanner(_SearchScanner):
+	"""Finds the ID of the first link to sourceClass on a page at baseURL."""
+
+	def __init__(self, sourceClass, baseURL):
+		super(_AnchorScanner, self).__init__()
+		self._sourceClass = sourceClass
+		self._baseURL = baseURL
+
+	def handle_starttag(self, tag, attrs):
+		if tag != 'a':
+			return
+		href = dict(attrs).get('href')
+		if not href:
+			return
+		res = self._sourceClass.PARSE_OPEN_URL_TO_ID.search(urllib.parse.urljoin(self._baseURL, href))
+		if not res:
+			return
+		id = self._sourceClass.ParseOpenURLToID(res.group(0))
+		if id:
+			self.match = id
+			raise _StopScan()
+
+class _TagTextScanner(_SearchScanner):
+	"""Finds the text of the first tag element."""
+
+	def __init__(self, tag):
+		super(_TagTextScanner, self).__init__()
+		self._tag = tag
+		self._text = None
+
+	def handle_starttag(self, tag, attrs):
+		if tag == self._tag:
+			self._text = []
+
+	def handle_data(self, data):
+		if self._text is not None:
+			self._text.append(data)
+
+	def handle_endtag(self, tag):
+		if tag == self._tag and self._text is not None:
+			self.match = ''.join(self._text)
+			raise _StopScan()
 
 class Source(object):
 	KEY = None
@@ -23,22 +98,20 @@ class Source(object):
 	def SearchURL(cls, terms):
 		return cls.SEARCH_URL % (urllib.parse.quote(terms),)
 	@classmethod
-	def GetBestMatch(cls, terms):
+	def _SearchResponse(cls, url, **kwargs):
+		response = httpclient.Get(url, source=cls.KEY, headers={'User-Agent': httpclient.BROWSER_USER_AGENT}, timeout=5, stream=True, **kwargs)
+		if response.status_code != 200:
+			response.close()
+			raise RuntimeError('%s: Search failed with HTTP %d: %s' % (cls.__name__, response.status_code, url))
+		return response
+	@classmethod
+	def _Search(cls, terms):
 		searchURL = cls.SearchURL(terms)
-		content = requests.get(searchURL, headers={'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2062.120 Safari/537.36'}, timeout=5).text
-		soup = bs4.BeautifulSoup(content)
-		for tag in soup.find_all('a'):
-			try:
-				url = urllib.parse.urljoin(searchURL, tag['href'])
-				res = cls.PARSE_OPEN_URL_TO_ID.search(url)
-				if not res:
-					continue
-				id = cls.ParseOpenURLToID(res.group(0))
-				if id:
-					return id
-			except KeyError:
-				pass
-		return None
+		return _AnchorScanner.Scan(cls._SearchResponse(searchURL), cls, searchURL)
+	@classmethod
+	def GetBestMatch(cls, terms):
+		"""Returns the ID of the first result of searching for terms, or None. Results are cached for webcache.SEARCH_TTL."""
+		return webcache.Search(cls.__name__, terms, lambda: cls._Search(terms))
 	@classmethod
 	def OpenURL(cls, id):
 		return cls.OPEN_URL % (urllib.parse.quote(str(id)),)
@@ -67,7 +140,27 @@ class TVDB(Source):
 	OPEN_URL = 'http://thetvdb.com/?tab=series&id=%s'
 	PARSE_OPEN_URL_TO_ID = re.compile(r'://[^/]*thetvdb.com/.*[?&]id=(\d+)', re.IGNORECASE)
 	ART_RESOURCE_TYPES = ('background', 'banner', 'poster')
-	API = tvdb_api.Tvdb(language='en')
+	_EPISODE_INDEXES = {}
+	_EPISODE_INDEXES_LOCK = threading.Lock()
+
+	@classmethod
+	def GetShow(cls, id):
+		"""Returns the tvdbcache.Show for id, fetching it only if it is not cached or has gone stale."""
+		return tvdbcache.Get(id)
+
+	@classmethod
+	def GetEpisodeIndex(cls, id):
+		"""Returns a dict of the show's episodes by their TVDB ID as a string, built once per show for the run."""
+		with cls._EPISODE_INDEXES_LOCK:
+			index = cls._EPISODE_INDEXES.get(int(id))
+		if index is None:
+			index = {}
+			for season in cls.GetShow(id).values():
+				for episode in season.values():
+					index[str(episode['id'])] = episode
+			with cls._EPISODE_INDEXES_LOCK:
+				index = cls._EPISODE_INDEXES.setdefault(int(id), index)
+		return index
 
 class AniDB(Source):
 	KEY = 'anidb'
@@ -86,11 +179,9 @@ class MAL(Source):
 		import api_config
 		return api_config.mal_api_user, api_config.mal_api_password
 	@classmethod
-	def GetBestMatch(cls, terms):
-		return None # Return None for now; Incapsula is too easy to trip up.
-		soup = bs4.BeautifulSoup(requests.get('http://myanimelist.net/api/anime/search.xml?q=%s' % (urllib.parse.quote(terms),), auth=cls._GetAPICreds(), headers={'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2062.120 Safari/537.36'}, timeout=5).text)
-		entries = soup.find_all('id')
-		return entries[0].text if entries else None
+	def _Search(cls, terms):
+		# Rate-limited through httpclient.RATES, as Incapsula is too easy to trip up with bursts.
+		return _TagTextScanner.Scan(cls._SearchResponse('http://myanimelist.net/api/anime/search.xml?q=%s' % (urllib.parse.quote(terms),), auth=cls._GetAPICreds()), 'id')
 
 class HummingBird(Source):
 	KEY = 'hummingbird'
@@ -105,10 +196,10 @@ class HummingBird(Source):
 
 	@classmethod
 	def IDFromMALID(cls, malid):
-		return requests.get('https://hummingbird.me/api/v2/anime/myanimelist:%d' % (malid,), headers={'X-Client-Id': cls._GetAPIKey()}).json()['anime']['id']
+		return webcache.Get('https://hummingbird.me/api/v2/anime/myanimelist:%d' % (malid,), headers={'X-Client-Id': cls._GetAPIKey()}, source=cls.KEY).json()['anime']['id']
 
 	def Lookup(self):
-		return requests.get('https://hummingbird.me/api/v2/anime/%d' % (self.id,), headers={'X-Client-Id': self._GetAPIKey()}).json()
+		return webcache.Get('https://hummingbird.me/api/v2/anime/%d' % (self.id,), headers={'X-Client-Id': self._GetAPIKey()}, source=self.KEY).json()
 
 class IMDB(Source):
 	KEY = 'imdb'
@@ -138,18 +229,42 @@ class MiniTokyo(Source):
 
 infoFile = '.info'
 rootFile = '.root'
+stateDirectory = '.mm-tools'
+nfoIndexFile = 'nfo-index.json'
+infoCacheFile = 'info-cache.pickle'
+# libyaml's loader is several times faster than the pure Python one, when PyYAML was built with it.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 mediaExtension = '.mkv'
 nfoExtension = '.nfo'
 imageExtensions = ('png', 'jpg')
 imageExtensionMappings = {'jpeg': 'jpg', 'jpe': 'jpg'}
+imageSignatures = (
+	(b'\x89PNG\r\n\x1a\n', 'png'),
+	(b'\xff\xd8\xff', 'jpg'),
+	(b'GIF87a', 'gif'),
+	(b'GIF89a', 'gif'),
+	(b'BM', 'bmp'),
+)
 artResourceFilenames = {
 	'banner': 'banner',
 	'poster': 'poster',
 	'background': 'fanart',
 }
+discoveryJobs = 8
+discoveryLookahead = 64
 
 
 class Library(object):
+	_INSTANCES = {}
+
+	@classmethod
+	def Get(cls, path):
+		"""Returns the Library rooted at path, reading its .root file only the first time it is asked for."""
+		library = cls._INSTANCES.get(path)
+		if library is None:
+			library = cls._INSTANCES.setdefault(path, cls(path))
+		return library
+
 	def __init__(self, path):
 		self._path = path
 		data = readYAML(os.path.join(self.path, rootFile))['library']
@@ -174,16 +289,156 @@ class Library(object):
 	@property
 	def kodi_profiles(self):
 		return self._kodi_profiles
+	@property
+	def nfo_index(self):
+		return NFOIndex.ForRoot(self.path)
+	@property
+	def info_cache(self):
+		return InfoCache.ForRoot(self.path)
+
+	def StatePath(self, name):
+		"""Returns the path of name in the library's state directory, which holds caches and indexes kept between runs."""
+		return statePath(self.path, name)
 
 	def __str__(self):
 		return 'Library<%s>' % (self.path)
 
+class SidecarCache(object):
+	"""Base of the caches and indexes kept in a library's state directory: entries keyed by path, loaded on creation, and saved atomically
+	without the entries of paths that no longer exist. Without a path, entries are only kept in memory for the run.
+
+	Subclasses name their FILENAME, and bump their VERSION whenever their entries change; files of other versions are ignored. BINARY ones
+	are pickled rather than written as JSON."""
+
+	FILENAME = None
+	VERSION = 1
+	BINARY = False
+	_INSTANCES = {}
+	_INSTANCES_LOCK = threading.Lock()
+
+	@classmethod
+	def ForRoot(cls, root):
+		"""Returns the cache in the state directory of the library at root, saved at exit, or one kept in memory if root is None. Unlike
+		Library.Get, this does not read the .root file, so it keeps working when the library's reflected path, background or Kodi profiles
+		are not mounted."""
+		with SidecarCache._INSTANCES_LOCK:
+			cache = SidecarCache._INSTANCES.get((cls, root))
+			if cache is None:
+				cache = SidecarCache._INSTANCES[cls, root] = cls(statePath(root, cls.FILENAME) if root is not None else None)
+				atexit.register(cache.Save)
+			return cache
+
+	def __init__(self, path=None):
+		self._path = path
+		self._entries = {}
+		self._dirty = False
+		self._lock = threading.Lock()
+		if path is not None and os.path.isfile(path):
+			try:
+				with open(path, 'rb' if self.BINARY else 'r') as f:
+					state = pickle.load(f) if self.BINARY else json.load(f)
+			except Exception as e:
+				print('Warning: Ignoring unreadable %s: %s' % (self, e))
+			else:
+				if isinstance(state, dict) and state.get('version') == self.VERSION:
+					self._Restore(state)
+
+	@property
+	def path(self):
+		return self._path
+
+	def _Restore(self, state):
+		self._entries = state['entries']
+
+	def _Snapshot(self):
+		"""Returns the state to save. Called with the lock held."""
+		return {'version': self.VERSION, 'entries': {path: entry for path, entry in self._entries.items() if os.path.exists(path)}}
+
+	def _Get(self, path):
+		with self._lock:
+			return self._entries.get(path)
+
+	def _Set(self, path, entry):
+		with self._lock:
+			self._entries[path] = entry
+			self._dirty = True
+
+	def _Validated(self, path, compute):
+		"""Returns compute(path), computed again only once the size or mtime of path changes."""
+		st = os.stat(path)
+		entry = self._Get(path)
+		if entry is not None and entry[:2] == [st.st_size, st.st_mtime_ns]:
+			return entry[2]
+		value = compute(path)
+		self._Set(path, [st.st_size, st.st_mtime_ns, value])
+		return value
+
+	def Save(self):
+		with self._lock:
+			if not self._dirty or self.path is None:
+				return
+			state = self._Snapshot()
+			self._dirty = False
+		atomicWrite(self.path, pickle.dumps(state, pickle.HIGHEST_PROTOCOL) if self.BINARY else json.dumps(state, sort_keys=True))
+
+	def __str__(self):
+		return '%s<%s>' % (self.__class__.__name__, self.path or ':memory:')
+
+class NFOIndex(SidecarCache):
+	"""Sidecar index of NFO path to content hash, validated by size and mtime, so that unchanged NFOs can be skipped without being read."""
+
+	FILENAME = nfoIndexFile
+
+	@staticmethod
+	def Digest(data):
+		return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+	def IsCurrent(self, nfo_path, digest):
+		"""Whether nfo_path is known to hold content with this digest and has not been touched since."""
+		entry = self._Get(nfo_path)
+		if entry is None or entry[2] != digest:
+			return False
+		try:
+			st = os.stat(nfo_path)
+		except FileNotFoundError:
+			return False
+		return [st.st_size, st.st_mtime_ns] == entry[:2]
+
+	def Record(self, nfo_path, digest):
+		st = os.stat(nfo_path)
+		self._Set(nfo_path, [st.st_size, st.st_mtime_ns, digest])
+
+class InfoCache(SidecarCache):
+	"""Parsed .info files keyed by path and validated by mtime and size, so that unchanged ones are never parsed again.
+
+	Entries hold the pickled data, which unpickles much faster than YAML parses, and gives every reader its own copy to modify."""
+
+	FILENAME = infoCacheFile
+	VERSION = 2
+	BINARY = True
+
+	def Read(self, info_path):
+		return pickle.loads(self._Validated(info_path, lambda path: pickle.dumps(parseYAML(path), pickle.HIGHEST_PROTOCOL)))
+
 class Episode(object):
 	_EPISODE_NUMBER_GUESS_REGEXES = (
 		r'(?:[^0-9a-z]|\b|(?:(?:[^0-9a-z]|\b)se?\d{1,3}))ep?(\d{2,3})(?!-bit)(?:v\d+)?(?:[^0-9a-z]|\b)',
 		r'(?:[^0-9a-z]|\b|(?:(?:[^0-9a-z]|\b)se?\d{1,3}[-_\s]))(\d{2,3})(?!-bit)(?:v\d+)?(?:[^0-9a-z]|\b)',
 		r'[^[a-z0-9](\d{2,3})(?!-bit)(?:v\d+)?(?:[^0-9a-z]|\b)',
 	)
+	# The numbers the second guess regex can pick, which it picks the last of.
+	_STANDALONE_NUMBER = re.compile(r'(?<![0-9a-z])(\d{2,3})(?!-bit)(?:v\d+)?(?![0-9a-z])', re.IGNORECASE)
+	_EPISODE_NUMBER_TEMPLATE_FIELD = re.compile(r'(\d{2,3})(?!\d)(?!-bit)(?:v\d+)?(?![0-9a-z])', re.IGNORECASE)
+	# Names without this cannot match the first (ep-prefixed) guess regex, which is by far the slowest.
+	_EPISODE_PREFIX_HINT = re.compile(r'ep?\d{2}', re.IGNORECASE)
+	_COMPILED_GUESS_REGEXES = {}
+
+	@classmethod
+	def _CompileGuessRegex(cls, regex):
+		compiled = cls._COMPILED_GUESS_REGEXES.get(regex)
+		if compiled is None:
+			compiled = cls._COMPILED_GUESS_REGEXES[regex] = re.compile('^.*(?:%s)' % (regex,), re.IGNORECASE)
+		return compiled
 
 	@classmethod
 	def GuessEpisodeNumber(cls, filename, override_regex=None):
@@ -193,11 +448,67 @@ class Episode(object):
 		if filename.endswith(mediaExtension):
 			filename = filename[:-len(mediaExtension)]
 		for r in regexes:
-			result = re.match('^.*(?:%s).*$' % (r,), filename, re.IGNORECASE)
+			result = cls._CompileGuessRegex(r).match(filename)
 			if result and result.group(1).isdigit():
 				return int(result.group(1))
 		return None
 
+	@classmethod
+	def GuessEpisodeNumbers(cls, filenames, override_regex=None):
+		"""Guesses episode numbers for all of a season's filenames at once. Returns a dict of filename to episode number (or None).
+
+		Sorted names are diffed against their neighbour: where two names first differ inside a number, the text before it is a template
+		shared by the season. Names starting with a template have their number read right after it, provided the numbers so read are
+		consistent with what GuessEpisodeNumber would find; the others go through GuessEpisodeNumber."""
+		stems = {}
+		for f in filenames:
+			stems[f] = f[:-len(mediaExtension)] if f.endswith(mediaExtension) else f
+		ordered = list(sorted(set(stems.values())))
+		templates = set()
+		for a, b in zip(ordered, ordered[1:]):
+			i = len(os.path.commonprefix((a, b)))
+			while i > 0 and a[i - 1].isdigit():
+				i -= 1
+			if cls._EPISODE_NUMBER_TEMPLATE_FIELD.match(a, i) and cls._EPISODE_NUMBER_TEMPLATE_FIELD.match(b, i):
+				templates.add(a[:i])
+		templates = list(sorted(templates, key=len, reverse=True))
+		override = cls._CompileGuessRegex(override_regex) if override_regex else None
+		prefixed = cls._CompileGuessRegex(cls._EPISODE_NUMBER_GUESS_REGEXES[0])
+		guesses = {}
+		byTemplate = {}
+		for f, stem in stems.items():
+			if override:
+				result = override.match(stem)
+				if result and result.group(1).isdigit():
+					guesses[f] = int(result.group(1))
+					continue
+			for template in templates:
+				if stem.startswith(template):
+					result = cls._EPISODE_NUMBER_TEMPLATE_FIELD.match(stem, len(template))
+					if result:
+						byTemplate.setdefault(template, {})[f] = int(result.group(1))
+						break
+			else:
+				guesses[f] = cls.GuessEpisodeNumber(stem)
+		# A template's numbers are only trusted when they form a run of distinct numbers, agree with the ep-prefixed guess wherever there
+		# is one, as that one takes precedence, and are what the next guess picks, which is the last standalone number of the name (so not
+		# '03' in 'Show - 03 - The 100 Days'). Otherwise its files go through GuessEpisodeNumber like the rest.
+		for template, numbers in byTemplate.items():
+			values = list(sorted(numbers.values()))
+			trusted = len(set(values)) == len(values) and values[-1] - values[0] == len(values) - 1
+			for f, number in numbers.items():
+				if not trusted:
+					break
+				result = prefixed.match(stems[f]) if cls._EPISODE_PREFIX_HINT.search(stems[f]) else None
+				if result and result.group(1).isdigit():
+					trusted = int(result.group(1)) == number
+					continue
+				start = len(template)
+				trusted = cls._STANDALONE_NUMBER.match(stems[f], start) is not None and not cls._STANDALONE_NUMBER.search(stems[f], start + 1)
+			for f, number in numbers.items():
+				guesses[f] = number if trusted else cls.GuessEpisodeNumber(stems[f])
+		return guesses
+
 	def __init__(self, parent, index, filename, title=None, summary=None, airdate=None, subseries=None):
 		self._parent = parent
 		self._index = str(index)
@@ -206,6 +517,7 @@ class Episode(object):
 		self._summary = summary
 		self._airdate = airdate
 		self._subseries = subseries
+		self._index_padding = None
 	@property
 	def parent(self):
 		return self._parent
@@ -237,7 +549,9 @@ class Episode(object):
 		return self._airdate
 	@property
 	def index_padding(self):
-		return math.ceil(math.log(len(self.parent.episodes) + 1, 10))
+		if self._index_padding is None:
+			self._index_padding = math.ceil(math.log(len(self.parent.episodes) + 1, 10))
+		return self._index_padding
 	@property
 	def title(self):
 		if self._title:
@@ -264,19 +578,7 @@ class Episode(object):
 		assert self.filename.endswith(mediaExtension)
 
 	def OverwriteNFO(self, data):
-		if os.path.exists(self.nfo_path):
-			currentNFOHandle = open(self.nfo_path, 'r')
-			currentNFO = currentNFOHandle.read(-1)
-			currentNFOHandle.close()
-			if currentNFO == data:
-				return
-		print('Writing to', self.nfo_path, ':')
-		print('-' * 80)
-		print(data)
-		print('-' * 80)
-		f = open(self.nfo_path, 'w')
-		f.write(data)
-		f.close()
+		overwriteNFO(self.parent.library, self.nfo_path, data)
 
 class Context(object):
 	KIND_SERIES = 'series'
@@ -300,6 +602,9 @@ class Context(object):
 
 	_SEARCHABLE_FILTER = re.compile(r'[^\s\w]')
 	_SEARCHABLE_JOIN = re.compile(r'\s+')
+	_NUMBERED_BACKREFERENCE = re.compile(r'\\[1-9]')
+	_OVERRIDE_MATCHERS = {}
+	_OVERWRITE_LOCK = threading.Lock()
 
 	def __init__(self, parent, path):
 		self._parent = parent
@@ -311,8 +616,12 @@ class Context(object):
 		self._soundtrack = {}
 		self._ignore = False
 		self._kind = None
+		self._episodes = None
 
 	@property
+	def parent(self):
+		return self._parent
+	@property
 	def path(self):
 		return self._path
 	@property
@@ -335,28 +644,22 @@ class Context(object):
 		return self._soundtrack
 	@property
 	def under_root_path(self):
-		if self.is_root:
+		root = self.root
+		if self.path == root:
 			return None
-		under_root = self.path
-		while not os.path.exists(os.path.join(os.path.dirname(under_root), rootFile)):
-			if under_root == os.path.dirname(under_root):
-				raise RuntimeError('Cannot determine media library under-root-path from %s' % (self.path,))
-			under_root = os.path.dirname(under_root)
-		return under_root
+		return os.path.join(root, self.path[len(root):].lstrip(os.sep).split(os.sep)[0])
 	@property
 	def is_right_under_root(self):
 		return self.under_root_path == self.path
 	@property
 	def root(self):
-		root = self.path
-		while not os.path.exists(os.path.join(root, rootFile)):
-			if root == os.path.dirname(root):
-				raise RuntimeError('Cannot determine media library root from %s' % (self.path,))
-			root = os.path.dirname(root)
+		root = findRoot(self.path)
+		if root is None:
+			raise RuntimeError('Cannot determine media library root from %s' % (self.path,))
 		return root
 	@property
 	def library(self):
-		return Library(self.root)
+		return Library.Get(self.root)
 	@property
 	def reflected_root(self):
 		return self.library.reflected_path
@@ -367,7 +670,7 @@ class Context(object):
 		assert path.startswith(root + os.sep)
 		reflected = os.path.join(self.reflected_root, path[len(root):].lstrip(os.sep))
 		if not os.path.isdir(reflected):
-			os.makedirs(reflected)
+			os.makedirs(reflected, exist_ok=True)
 		return reflected
 	@property
 	def is_root(self):
@@ -445,6 +748,9 @@ class Context(object):
 	def filenames(self):
 		return list(sorted(f for f in os.listdir(self.path)))
 	@property
+	def has_subcontexts(self):
+		return _hasInfoBelow(self.path)
+	@property
 	def media_filenames(self):
 		return list(f for f in self.filenames if f.endswith(mediaExtension))
 	@property
@@ -464,8 +770,14 @@ class Context(object):
 		return os.path.join(self.reflected_path, 'Movie.ep00' + mediaExtension)
 	@property
 	def episodes(self):
+		"""Episode list, built once and reused until the directory changes or InvalidateEpisodes is called."""
 		if self.kind not in (self.KIND_SEASON, self.KIND_OVA):
-			raise RuntimeError('%s: Cannot list episodes, this is not a season/OVA')
+			raise RuntimeError('%s: Cannot list episodes, this is not a season/OVA' % (self,))
+		mtime = os.stat(self.path).st_mtime_ns
+		if self._episodes is None or self._episodes[0] != mtime:
+			self._episodes = (mtime, self._BuildEpisodes())
+		return self._episodes[1]
+	def _BuildEpisodes(self):
 		if self.metadata_preferences.get('disable_episodes'):
 			return []
 		if not self.metadata_single:
@@ -482,21 +794,17 @@ class Context(object):
 		episodes = {}
 		overridden = set()
 		override_regex = self.Get('override_epregex')
-		for pattern, data in (self.Get('override_epdata') or {}).items():
+		guesses = Episode.GuessEpisodeNumbers(files, override_regex)
+		overrides = self.Get('override_epdata') or {}
+		for pattern, data in overrides.items():
 			if 'index' not in data and all(k not in data for k in self.EPDATA_SUBSERIES_KNOWN_KEYS):
 				raise RuntimeError('%s: Episode override with pattern %r (data %r) has no index nor subseries information' % (self, pattern, data))
-			matched = None
-			r = re.compile(pattern, re.IGNORECASE)
-			for f in files:
-				if r.search(f):
-					if matched:
-						raise RuntimeError('%s: Pattern %r matched two files: %r and %r' % (self, pattern, matched, f))
-					matched = f
-			if matched is None:
-				raise RuntimeError('%s: Pattern %r matched no files' % (self, pattern))
+		overrideMatches = self._MatchOverrides(tuple(overrides.keys()), files)
+		for pattern, data in overrides.items():
+			matched = overrideMatches[pattern]
 			ep = data.get('index')
 			if ep is None:
-				ep = Episode.GuessEpisodeNumber(matched, override_regex)
+				ep = guesses[matched]
 				if ep is None:
 					raise RuntimeError('%s: Episode override with pattern %r and no index information matched file %r for which we cannot determine the episode number' % (self, pattern, matched))
 			subseries = '__main__'
@@ -512,7 +820,7 @@ class Context(object):
 		for f in files:
 			if f in overridden:
 				continue
-			ep = Episode.GuessEpisodeNumber(f, override_regex)
+			ep = guesses[f]
 			if ep is not None:
 				index = '%s:%s' % ('__main__', ep)
 				if index in episodes:
@@ -530,6 +838,9 @@ class Context(object):
 			if index not in episodes:
 				raise RuntimeError('%s: Could not find episode %s. Found:\n%r\nFiles:\n%r\n' % (self, index, list(sorted(x.filename for x in episodes.values())), files))
 			eplist.append(episodes[index])
+		padding = math.ceil(math.log(len(eplist) + 1, 10))
+		for ep in episodes.values():
+			ep._index_padding = padding
 		return eplist
 	@property
 	def reflected_links(self):
@@ -566,6 +877,63 @@ class Context(object):
 			self.KIND_IGNORE: (),
 		}[self.kind]
 
+	@classmethod
+	def _CompileOverrideAlternation(cls, patterns, order=None):
+		"""Compiles patterns into a single alternation. Returns False if they cannot be combined. If order is given, it lists the indexes
+		of the patterns in the order they are tried, each in a group named after its index.
+
+		Alternations without groups search much faster, as the regex compiler can then merge the literal prefixes of the patterns."""
+		if any(cls._NUMBERED_BACKREFERENCE.search(p) for p in patterns):
+			return False
+		alternatives = ['(?:%s)' % (p,) for p in patterns] if order is None else ['(?P<_override%d>%s)' % (i, patterns[i]) for i in order]
+		try:
+			return re.compile('|'.join(alternatives), re.IGNORECASE)
+		except re.error:
+			return False # E.g. duplicate group names or inline flags; match patterns one by one instead.
+
+	@classmethod
+	def _CompileOverrideMatcher(cls, patterns):
+		"""Compiles override_epdata patterns once per pattern set. Returns (each, scan, first, last): each holds the compiled patterns, scan
+		finds where any of them first matches, and first and last tell the first and last of them matching there. The last three are
+		False if the patterns cannot be combined."""
+		matcher = cls._OVERRIDE_MATCHERS.get(patterns)
+		if matcher is None:
+			each = tuple(re.compile(p, re.IGNORECASE) for p in patterns)
+			scan = cls._CompileOverrideAlternation(patterns)
+			first = scan and cls._CompileOverrideAlternation(patterns, range(len(patterns)))
+			last = first and cls._CompileOverrideAlternation(patterns, range(len(patterns) - 1, -1, -1))
+			matcher = cls._OVERRIDE_MATCHERS[patterns] = (each, scan, first, last) if last else (each, False, False, False)
+		return matcher
+
+	def _MatchOverrides(self, patterns, files):
+		"""Assigns files to the override_epdata patterns. Returns a dict of pattern to matched filename.
+
+		Each file is searched once with the combined patterns, and given to the first pattern matching where any pattern first matches.
+		Only files that another pattern could match too, later on or at that same place, are checked against every pattern, so that a
+		pattern matching two files is still caught."""
+		each, scan, first, last = self._CompileOverrideMatcher(patterns) if patterns else ((), False, False, False)
+		found = [[] for _ in patterns]
+		for f in files:
+			if scan:
+				m = scan.search(f)
+				if m is None:
+					continue
+				i = first.match(f, m.start()).lastgroup
+				if i == last.match(f, m.start()).lastgroup and not scan.search(f, m.start() + 1):
+					found[int(i[len('_override'):])].append(f)
+					continue
+			for i, r in enumerate(each):
+				if r.search(f):
+					found[i].append(f)
+		matched = {}
+		for pattern, fs in zip(patterns, found):
+			if len(fs) > 1:
+				raise RuntimeError('%s: Pattern %r matched two files: %r and %r' % (self, pattern, fs[0], fs[1]))
+			if not fs:
+				raise RuntimeError('%s: Pattern %r matched no files' % (self, pattern))
+			matched[pattern] = fs[0]
+		return matched
+
 	def GetSingle(self, key):
 		return self.kind_data.get(key)
 	def Get(self, key):
@@ -595,9 +963,10 @@ class Context(object):
 			for ep in self.episodes:
 				ep.sanityCheck()
 
-	def SubContext(self, path, data):
-		"""Returns a new Context with overlaid data."""
-		self.sanityCheck()
+	def SubContext(self, path, data, check=True):
+		"""Returns a new Context with overlaid data. Unless check is false, both Contexts are sanity checked, which lists their files."""
+		if check:
+			self.sanityCheck()
 		folderName = os.path.basename(path)
 		sub = self.__class__(self, path)
 		sub._series = self.series.copy()
@@ -632,18 +1001,26 @@ class Context(object):
 			sub._kind = self.KIND_SOUNDTRACK
 		if 'ignore' in data:
 			sub._kind = self.KIND_IGNORE
-		sub.sanityCheck()
+		if check:
+			sub.sanityCheck()
 		return sub
 
 	def GatherSubContexts(self):
 		yield self
 		yield from traverse(self.path, self)
 
+	def InvalidateEpisodes(self):
+		self._episodes = None
+
 	def SetMetadata(self, metadata):
 		self.kind_data['www_metadata'] = metadata
 		self.Overwrite()
 
 	def Overwrite(self):
+		with self._OVERWRITE_LOCK: # Contexts may be processed concurrently; keep .info writes one at a time.
+			self._Overwrite()
+	def _Overwrite(self):
+		self.InvalidateEpisodes()
 		self.sanityCheck()
 		finalData = {}
 		for key, dataFunc in {'series': lambda x: x.series, 'season': lambda x: x.season, 'movie': lambda x: x.movie, 'ova': lambda x: x.ova, 'soundtrack': lambda x: x.soundtrack}.items():
@@ -669,19 +1046,7 @@ class Context(object):
 		if nfo_path is None:
 			nfo_path = self.nfo_path
 		assert nfo_path
-		if os.path.exists(nfo_path):
-			currentNFOHandle = open(nfo_path, 'r')
-			currentNFO = currentNFOHandle.read(-1)
-			currentNFOHandle.close()
-			if currentNFO == data:
-				return
-		print('Writing to', nfo_path, ':')
-		print('-' * 80)
-		print(data)
-		print('-' * 80)
-		f = open(nfo_path, 'w')
-		f.write(data)
-		f.close()
+		overwriteNFO(self.library, nfo_path, data)
 
 	def __str__(self):
 		"""String representation."""
@@ -691,27 +1056,186 @@ class Context(object):
 
 	__repr__ = __str__
 
+_roots = {}
+def findRoot(path):
+	"""Returns the closest directory at or above path that holds a .root file, or None. Lookups are memoized for the whole run, so sibling Contexts share the walk."""
+	visited = []
+	root = None
+	while True:
+		if path in _roots:
+			root = _roots[path]
+			break
+		visited.append(path)
+		if os.path.exists(os.path.join(path, rootFile)):
+			root = path
+			break
+		parent = os.path.dirname(path)
+		if parent == path:
+			break
+		path = parent
+	for p in visited:
+		_roots[p] = root
+	return root
+
+def statePath(root, name):
+	"""Returns the path of name in the state directory of the library at root, creating the directory if needed."""
+	directory = os.path.join(root, stateDirectory)
+	if not os.path.isdir(directory):
+		os.makedirs(directory, exist_ok=True)
+	return os.path.join(directory, name)
+
+def configureCaches(paths, offline=False):
+	"""Keeps HTTP responses and TVDB shows in the state directory of the first library found among paths. Returns the HTTP cache."""
+	for path in paths:
+		root = findRoot(os.path.abspath(path))
+		if root is not None:
+			tvdbcache.Configure(statePath(root, tvdbcache.cacheFile), offline=offline)
+			return webcache.Configure(statePath(root, webcache.cacheFile), offline=offline)
+	tvdbcache.Configure(offline=offline)
+	return webcache.Configure(offline=offline)
+
+def _readUmask():
+	umask = os.umask(0o022)
+	os.umask(umask)
+	return umask
+
+# The mode open() gives new files, for files created through makeTemporary, as mkstemp only grants access to the owner. The umask is read once, on
+# import, as reading it means briefly changing it for every thread.
+newFileMode = 0o666 & ~_readUmask()
+
+def sniffImageExtension(head):
+	"""Returns the image extension matching the first bytes of a file, or None if they are not recognized."""
+	for signature, extension in imageSignatures:
+		if head.startswith(signature):
+			return extension
+	if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+		return 'webp'
+	return None
+
+def makeTemporary(directory, prefix, suffix):
+	"""Like tempfile.mkstemp, but the file gets the mode new files get, as mkstemp only grants access to the owner."""
+	handle, temporary = tempfile.mkstemp(dir=directory, prefix=prefix, suffix=suffix)
+	os.fchmod(handle, newFileMode)
+	return handle, temporary
+
+def atomicWrite(path, content):
+	"""Writes content (str or bytes) to path through a temporary file and a rename, so that readers never see it half-written."""
+	handle, temporary = makeTemporary(os.path.dirname(path), '.%s.' % (os.path.basename(path),), '.tmp')
+	try:
+		with os.fdopen(handle, 'wb' if isinstance(content, bytes) else 'w') as f:
+			f.write(content)
+		if os.path.exists(path):
+			os.chmod(temporary, stat.S_IMODE(os.stat(path).st_mode))
+		os.replace(temporary, path)
+	except BaseException:
+		os.remove(temporary)
+		raise
+
+def overwriteNFO(library, nfo_path, data):
+	"""Atomically writes data to nfo_path, unless the library's NFO index or the file itself shows it already holds it."""
+	index = library.nfo_index
+	digest = index.Digest(data)
+	if index.IsCurrent(nfo_path, digest):
+		return
+	if os.path.exists(nfo_path):
+		with open(nfo_path, 'r') as f:
+			if f.read() == data:
+				index.Record(nfo_path, digest)
+				return
+	print('Writing to', nfo_path, ':')
+	print('-' * 80)
+	print(data)
+	print('-' * 80)
+	atomicWrite(nfo_path, data)
+	index.Record(nfo_path, digest)
+
+def parseYAML(path):
+	with open(path, 'r') as f:
+		raw = f.read().replace('\t', '  ')
+	return yaml.load(raw, Loader=_YAML_LOADER)
+
 def readYAML(path):
-	f = open(path, 'r')
-	raw = f.read().replace('\t', '  ')
-	f.close()
-	return yaml.load(raw)
-
-def traverse(path, context):
-	"""Traverse path and its subdirectories, picking up files as it goes. Yields Contexts."""
-	entries = list(sorted(os.listdir(path)))
-	if infoFile in entries:
-		data = readYAML(os.path.join(path, infoFile))
-		context = context.SubContext(path, data)
+	"""Returns the data in the YAML file at path. .info files inside a library go through its InfoCache."""
+	if os.path.basename(path) == infoFile:
+		root = findRoot(os.path.dirname(os.path.abspath(path)))
+		if root is not None:
+			return InfoCache.ForRoot(root).Read(os.path.abspath(path))
+	return parseYAML(path)
+
+def _hasInfoBelow(path):
+	"""Whether a directory below path has an .info file. Stops listing at the first one found."""
+	pending = [path]
+	while pending:
+		with os.scandir(pending.pop()) as entries:
+			for entry in entries:
+				if entry.name != stateDirectory and entry.is_dir():
+					if os.path.isfile(os.path.join(entry.path, infoFile)):
+						return True
+					pending.append(entry.path)
+	return False
+
+def _scanDirectory(path):
+	"""Lists path once, returning its sorted subdirectory names and its parsed .info data (None if it has none)."""
+	subdirectories = []
+	hasInfo = False
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if entry.name == infoFile:
+				hasInfo = True
+			elif entry.name != stateDirectory and entry.is_dir(): # Uses d_type when the filesystem provides it, so no extra stat.
+				subdirectories.append(entry.name)
+	return list(sorted(subdirectories)), readYAML(os.path.join(path, infoFile)) if hasInfo else None
+
+def Discover(path):
+	"""Walk path and its subdirectories in sorted depth-first order. Yields (path, data) for each directory with an .info file.
+
+	Directories are listed and their .info parsed on a bounded thread pool, up to discoveryLookahead directories ahead of the consumer."""
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=discoveryJobs)
+	try:
+		pending = [[path, None]]
+		while pending:
+			for item in pending[-discoveryLookahead:]:
+				if item[1] is None:
+					item[1] = executor.submit(_scanDirectory, item[0])
+			directory, future = pending.pop()
+			subdirectories, data = future.result()
+			if data is not None:
+				yield directory, data
+			pending.extend([os.path.join(directory, s), None] for s in reversed(subdirectories))
+	finally:
+		executor.shutdown(wait=False, cancel_futures=True)
+
+def traverse(path, context, discovered=None, check=True):
+	"""Traverse path and its subdirectories, picking up files as it goes. Yields Contexts.
+
+	discovered replaces Discover(path) as the source of (path, data) pairs, for callers that look at them ahead of the traversal. If check
+	is false, Contexts are not sanity checked, which leaves listing their files and building their episodes to whatever uses them."""
+	parents = [(path, context)]
+	for directory, data in (Discover(path) if discovered is None else discovered):
+		while len(parents) > 1 and not directory.startswith(parents[-1][0] + os.sep):
+			parents.pop()
+		context = parents[-1][1].SubContext(directory, data, check=check)
+		parents.append((directory, context))
 		yield context
-	for entry in entries:
-		fullEntry = os.path.join(path, entry)
-		if os.path.isdir(fullEntry):
-			yield from traverse(fullEntry, context)
 
-def Traverse(path):
+def LoadContext(base, path):
+	"""Returns the Context that Traverse(base) would have built for the closest directory with an .info at or above path, reading only the
+	.info files between base and path. If there is none, returns the base Context."""
+	base = os.path.abspath(base)
+	path = os.path.abspath(path)
+	if path != base and not path.startswith(base + os.sep):
+		raise RuntimeError('%s is not under %s' % (path, base))
+	context = Context(None, base)
+	directory = base
+	for component in [''] + path[len(base):].strip(os.sep).split(os.sep):
+		directory = os.path.join(directory, component) if component else directory
+		if os.path.isfile(os.path.join(directory, infoFile)):
+			context = context.SubContext(directory, readYAML(os.path.join(directory, infoFile)))
+	return context
+
+def Traverse(path, discovered=None, check=True):
 	path = os.path.abspath(path)
 	if not os.path.isdir(path):
 		print('Warning: Skipping traversal of', path, 'as it is not a directory.')
 		return
-	yield from traverse(path, Context(None, path))
+	yield from traverse(path, Context(None, path), discovered, check)
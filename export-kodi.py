@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import data
+
+_databaseGlob = 'userdata/Database/MyVideos*.db'
+_databaseVersion = re.compile(r'MyVideos(\d+)\.db$')
+_standInDatabase = 'userdata/Database/MyVideos116.db'
+
+_CONTENT_COLUMNS = ', '.join('c%02d TEXT' % (i,) for i in range(24))
+
+# The parts of Kodi's video database that the exporter writes to, for creating a stand-in to test against without Kodi.
+_STAND_IN_SCHEMA = """
+CREATE TABLE IF NOT EXISTS path (idPath INTEGER PRIMARY KEY, strPath TEXT, strContent TEXT, strScraper TEXT, strHash TEXT, scanRecursive INTEGER, useFolderNames BOOL, strSettings TEXT, noUpdate BOOL, exclude BOOL, dateAdded TEXT, idParentPath INTEGER);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_path ON path (strPath);
+CREATE TABLE IF NOT EXISTS files (idFile INTEGER PRIMARY KEY, idPath INTEGER, strFilename TEXT, playCount INTEGER, lastPlayed TEXT, dateAdded TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_files ON files (idPath, strFilename);
+CREATE TABLE IF NOT EXISTS tvshow (idShow INTEGER PRIMARY KEY, %(columns)s, userrating INTEGER, duration INTEGER);
+CREATE TABLE IF NOT EXISTS tvshowlinkpath (idShow INTEGER, idPath INTEGER);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_tvshowlinkpath_1 ON tvshowlinkpath (idShow, idPath);
+CREATE TABLE IF NOT EXISTS seasons (idSeason INTEGER PRIMARY KEY, idShow INTEGER, season INTEGER, name TEXT, userrating INTEGER);
+CREATE TABLE IF NOT EXISTS episode (idEpisode INTEGER PRIMARY KEY, idFile INTEGER, %(columns)s, idShow INTEGER, userrating INTEGER, idSeason INTEGER);
+CREATE TABLE IF NOT EXISTS art (art_id INTEGER PRIMARY KEY, media_id INTEGER, media_type TEXT, type TEXT, url TEXT);
+CREATE INDEX IF NOT EXISTS ix_art ON art (media_id, media_type, type);
+""" % {'columns': _CONTENT_COLUMNS}
+
+# Content hashes of exported rows, keyed by reflected path, so that unchanged ones are skipped and changed ones updated in place.
+_TRACKING_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mm_tools_export (
+	media_type TEXT NOT NULL,
+	key TEXT NOT NULL,
+	media_id INTEGER NOT NULL,
+	hash TEXT NOT NULL,
+	PRIMARY KEY (media_type, key)
+);
+"""
+
+_TABLES = {
+	'tvshow': ('tvshow', 'idShow'),
+	'season': ('seasons', 'idSeason'),
+	'episode': ('episode', 'idEpisode'),
+}
+
+def FindDatabase(profile):
+	"""Returns the path of the newest MyVideos database of the Kodi profile, or None."""
+	databases = [(int(_databaseVersion.search(d).group(1)), d) for d in glob.glob(os.path.join(glob.escape(profile), _databaseGlob)) if _databaseVersion.search(d)]
+	return max(databases)[1] if databases else None
+
+class VideoDatabase(object):
+	"""A Kodi video database, written to in a single transaction. Paths, files, tracked rows and existing row IDs are loaded up front."""
+
+	def __init__(self, path, createSchema=False):
+		self._path = path
+		self._conn = sqlite3.connect(path, isolation_level=None)
+		if createSchema:
+			self._conn.executescript(_STAND_IN_SCHEMA)
+		self._conn.executescript(_TRACKING_SCHEMA)
+		self._conn.execute('BEGIN IMMEDIATE')
+		self._tracked = {(mediaType, key): (mediaId, digest) for mediaType, key, mediaId, digest in self._conn.execute('SELECT media_type, key, media_id, hash FROM mm_tools_export')}
+		self._existing = {mediaType: {row[0] for row in self._conn.execute('SELECT %s FROM %s' % (idColumn, table))} for mediaType, (table, idColumn) in _TABLES.items()}
+		self._paths = dict(self._conn.execute('SELECT strPath, idPath FROM path'))
+		self._files = {(idPath, filename): idFile for idFile, idPath, filename in self._conn.execute('SELECT idFile, idPath, strFilename FROM files')}
+		self._links = set(self._conn.execute('SELECT idShow, idPath FROM tvshowlinkpath'))
+		self._counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+	@property
+	def path(self):
+		return self._path
+	@property
+	def counts(self):
+		return self._counts
+
+	def Path(self, path, parent=None):
+		"""Returns the idPath of the directory path, inserting it if needed."""
+		if not path.endswith(os.sep):
+			path += os.sep
+		idPath = self._paths.get(path)
+		if idPath is None:
+			idPath = self._paths[path] = self._conn.execute('INSERT INTO path (strPath, idParentPath, dateAdded) VALUES (?, ?, ?)', (
+				path, parent, time.strftime('%Y-%m-%d %H:%M:%S'),
+			)).lastrowid
+		return idPath
+
+	def File(self, path, idPath):
+		"""Returns the idFile of path in the directory idPath, inserting it if needed."""
+		filename = os.path.basename(path)
+		idFile = self._files.get((idPath, filename))
+		if idFile is None:
+			idFile = self._files[(idPath, filename)] = self._conn.execute('INSERT INTO files (idPath, strFilename, dateAdded) VALUES (?, ?, ?)', (
+				idPath, filename, time.strftime('%Y-%m-%d %H:%M:%S'),
+			)).lastrowid
+		return idFile
+
+	def LinkShowPath(self, idShow, idPath):
+		if (idShow, idPath) not in self._links:
+			self._conn.execute('INSERT INTO tvshowlinkpath (idShow, idPath) VALUES (?, ?)', (idShow, idPath))
+			self._links.add((idShow, idPath))
+
+	def Lookup(self, mediaType, key):
+		"""Returns the ID of the row exported for key, or None."""
+		tracked = self._tracked.get((mediaType, key))
+		if tracked is None or tracked[0] not in self._existing[mediaType]:
+			return None
+		return tracked[0]
+
+	def Write(self, mediaType, key, row, art):
+		"""Inserts or updates the row exported for key along with its art (a dict of art type to URL), unless its content hash is unchanged.
+		Returns the row ID."""
+		table, idColumn = _TABLES[mediaType]
+		digest = hashlib.sha256(json.dumps([row, art], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+		mediaId = self.Lookup(mediaType, key)
+		columns = sorted(row)
+		if mediaId is not None:
+			if self._tracked[(mediaType, key)][1] == digest:
+				self._counts['unchanged'] += 1
+				return mediaId
+			self._conn.execute('UPDATE %s SET %s WHERE %s = ?' % (table, ', '.join('%s = ?' % (c,) for c in columns), idColumn), [row[c] for c in columns] + [mediaId])
+			self._counts['updated'] += 1
+		else:
+			mediaId = self._conn.execute('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns), ', '.join('?' * len(columns))), [row[c] for c in columns]).lastrowid
+			self._existing[mediaType].add(mediaId)
+			self._counts['inserted'] += 1
+		self._conn.execute('DELETE FROM art WHERE media_id = ? AND media_type = ?', (mediaId, mediaType))
+		self._conn.executemany('INSERT INTO art (media_id, media_type, type, url) VALUES (?, ?, ?, ?)', ((mediaId, mediaType, t, url) for t, url in sorted(art.items())))
+		self._conn.execute('INSERT OR REPLACE INTO mm_tools_export (media_type, key, media_id, hash) VALUES (?, ?, ?, ?)', (mediaType, key, mediaId, digest))
+		self._tracked[(mediaType, key)] = (mediaId, digest)
+		return mediaId
+
+	def Close(self, commit=True):
+		self._conn.execute('COMMIT' if commit else 'ROLLBACK')
+		self._conn.close()
+
+	def __str__(self):
+		return 'VideoDatabase<%s>' % (self.path,)
+
+def _Art(context):
+	"""Returns the art of context as a dict of Kodi art type to the path of the file in the reflected tree."""
+	art = {}
+	files = context.filenames
+	for filename in data.artResourceFilenames.values():
+		for ext in data.imageExtensions:
+			if '%s.%s' % (filename, ext) in files:
+				art[filename] = os.path.join(context.reflected_path, '%s.%s' % (filename, ext))
+				break
+	return art
+
+def _Genres(metadata):
+	return ' / '.join(metadata.get('genres', ()))
+
+def _Series(context):
+	"""Returns the series context belongs to, reading the .info files above it if the traversal started below its series, or None."""
+	parent = context.parent
+	while parent is not None and parent.kind != data.Context.KIND_SERIES:
+		parent = parent.parent
+	if parent is None and context.path != context.root:
+		parent = data.LoadContext(context.root, os.path.dirname(context.path))
+		while parent is not None and parent.kind != data.Context.KIND_SERIES:
+			parent = parent.parent
+	return parent
+
+class KodiExporter(object):
+	"""Writes shows, seasons and episodes straight into the video databases of the Kodi profiles of each context's library, the same way
+	mkreflection describes them in NFOs: movies are episode 0 of season 0 of their series, or of a show of their own."""
+
+	def __init__(self, createSchema=False):
+		self._createSchema = createSchema
+		self._libraries = {}
+		self._databases = {}
+
+	def _Open(self, library):
+		if library.path in self._libraries:
+			return self._libraries[library.path]
+		databases = []
+		for profile in library.kodi_profiles:
+			if profile not in self._databases:
+				database = FindDatabase(profile)
+				if database is None and self._createSchema:
+					database = os.path.join(profile, _standInDatabase)
+					os.makedirs(os.path.dirname(database), exist_ok=True)
+				if database is None:
+					raise RuntimeError('No MyVideos database found in Kodi profile %r.' % (profile,))
+				self._databases[profile] = VideoDatabase(database, createSchema=self._createSchema)
+			databases.append(self._databases[profile])
+		self._libraries[library.path] = databases
+		return databases
+
+	@staticmethod
+	def _Show(db, context):
+		metadata = context.metadata
+		idPath = db.Path(context.reflected_path)
+		idShow = db.Write('tvshow', context.reflected_path, {
+			'c00': context.name_noprefix,
+			'c01': metadata.get('summary', ''),
+			'c05': str(metadata.get('year', '')),
+			'c08': _Genres(metadata),
+			'c12': str(context.Get(data.TVDB.KEY) if context.kind == data.Context.KIND_SERIES else context.Get(data.IMDB.KEY)),
+			'c15': context.name,
+		}, _Art(context))
+		db.LinkShowPath(idShow, idPath)
+		return idShow
+
+	@staticmethod
+	def _Season(db, show, idShow, season, name, art):
+		return db.Write('season', '%s:%s' % (show.reflected_path, season), {'idShow': idShow, 'season': season, 'name': name}, art)
+
+	@staticmethod
+	def _Episode(db, show, idShow, idSeason, reflected, row):
+		idPath = db.Path(os.path.dirname(reflected), parent=db.Path(show.reflected_path))
+		row = dict(row, idFile=db.File(reflected, idPath), idShow=idShow, idSeason=idSeason, c18=reflected, c19=str(idPath))
+		return db.Write('episode', reflected, row, {})
+
+	def Export(self, context):
+		if context.kind not in (data.Context.KIND_SERIES, data.Context.KIND_SEASON, data.Context.KIND_MOVIE):
+			return
+		if context.kind == data.Context.KIND_SEASON and context.Get('season') is None:
+			print('Warning: %s has no season number. Skipping.' % (context,))
+			return
+		print('Exporting:', context)
+		for db in self._Open(context.library):
+			if context.kind == data.Context.KIND_SERIES:
+				self._Show(db, context)
+				continue
+			show = _Series(context)
+			if show is not None:
+				idShow = db.Lookup('tvshow', show.reflected_path)
+				if idShow is None: # The traversal started below the series.
+					idShow = self._Show(db, show)
+			elif context.kind == data.Context.KIND_SEASON:
+				print('Warning: %s is not in a series. Skipping.' % (context,))
+				continue
+			else:
+				show = context
+				idShow = self._Show(db, context)
+			metadata = context.metadata
+			if context.kind == data.Context.KIND_SEASON:
+				season = int(context.Get('season'))
+				idSeason = self._Season(db, show, idShow, season, context.name, _Art(context))
+				for ep in context.episodes:
+					if not ep.is_integer_ep:
+						continue
+					self._Episode(db, show, idShow, idSeason, ep.reflected_path, {
+						'c00': ep.title, 'c01': ep.summary or '', 'c05': ep.airdate or '', 'c12': str(season), 'c13': ep.index,
+					})
+			else:
+				idSeason = self._Season(db, show, idShow, 0, 'Specials', {})
+				self._Episode(db, show, idShow, idSeason, context.reflected_moviefilename, {
+					'c00': context.name_noprefix, 'c01': metadata.get('summary', ''), 'c05': str(metadata.get('year', '')), 'c12': '0', 'c13': '0',
+				})
+
+	def Close(self, commit=True):
+		"""Commits (or rolls back) the transaction of every database written to."""
+		for profile, db in sorted(self._databases.items()):
+			db.Close(commit=commit)
+			if commit:
+				print('Exported to %s: %d inserted, %d updated, %d unchanged.' % (db, db.counts['inserted'], db.counts['updated'], db.counts['unchanged']))
+		self._databases = {}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Export media directories straight into the video databases of their Kodi profiles.')
+	parser.add_argument('--create-schema', action='store_true', help='Create a stand-in of the tables written to, in a new database if the profile has none. For testing without Kodi.')
+	parser.add_argument('paths', nargs='+')
+	args = parser.parse_args()
+	exporter = KodiExporter(createSchema=args.create_schema)
+	try:
+		for path in args.paths:
+			for context in data.Traverse(path):
+				exporter.Export(context)
+	except BaseException:
+		exporter.Close(commit=False)
+		raise
+	exporter.Close()
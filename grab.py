@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 
-import imghdr
+import argparse
+import glob
+import hashlib
 import re
 import os
-import sys
 import time
 import mimetypes
 import html
+import importlib
 import requests
+import artstore
 import data
+import httpclient
+import libindex
+import parallel
+import tvdbcache
+import webcache
+
+_ART_CHUNK_SIZE = 64 * 1024
+_SNIFF_SIZE = 16
+_PARTIAL_SUFFIX = '.part'
 
 def MetadataFromHummingBird(context):
 	hummingbird = int(context.Get(data.HummingBird.KEY))
@@ -26,7 +38,7 @@ def MetadataFromHummingBird(context):
 
 def MetadataFromMAL(context):
 	mal = int(context.Get(data.MAL.KEY))
-	response = requests.get('https://malapi.shioridiary.me/anime/%d' % (mal,)).json()
+	response = webcache.Get('https://malapi.shioridiary.me/anime/%d' % (mal,), source=data.MAL.KEY).json()
 	synopsis = html.unescape(re.sub(r'<[^<>]+>', '', re.sub(r'<script[\s\S]*/script>', '', re.sub(r'<br[^<>]*>', '\n', re.sub(r'[\r\n]+', '', response['synopsis'].replace('&#13;', '\r')), re.IGNORECASE), re.IGNORECASE)))
 	synopsis = re.sub(r'\s*[[(]?Source:.*[])]?\s*$', '', synopsis, re.IGNORECASE)
 	synopsis = synopsis.replace('[Written by MAL Rewrite]', '')
@@ -41,8 +53,7 @@ def MetadataFromMAL(context):
 def EpDataFromTVDB(context):
 	epdata = {}
 	ep_mapping = context.metadata_preferences.get('tvdb_episode_mapping', {})
-	ep_mapping_found = {}
-	show = data.TVDB.API[int(context.Get(data.TVDB.KEY))]
+	show = data.TVDB.GetShow(context.Get(data.TVDB.KEY))
 	season = context.metadata_preferences.get('tvdb_season', context.Get('season'))
 	if season is None:
 		raise RuntimeError('%s has no season number defined' % (context,))
@@ -50,22 +61,20 @@ def EpDataFromTVDB(context):
 	episodes = context.episodes
 	if ep_mapping:
 		assert len(ep_mapping) == len(episodes)
+		index = data.TVDB.GetEpisodeIndex(context.Get(data.TVDB.KEY))
+		unmatched = []
 	for ep in episodes:
 		if not ep.is_integer_ep:
 			continue
-		episode = None
 		if ep_mapping:
-			mapping = str(ep_mapping[int(ep.index)])
-			for s in show.values():
-				for e in s.values():
-					if str(e['id']) == str(mapping):
-						episode = e
-						ep_mapping_found[int(ep.index)] = True
-						break
-				if episode is not None:
-					break
+			mapping = ep_mapping.get(int(ep.index))
+			if mapping is None:
+				unmatched.append('index %s: not mapped' % (ep.index,))
+				continue
+			episode = index.get(str(mapping))
 			if episode is None:
-				raise RuntimeError('%s: Episode mapping for index %s found no match' % (context, ep.index))
+				unmatched.append('index %s: no episode with ID %s' % (ep.index, mapping))
+				continue
 		else:
 			episode = season[int(ep.index)]
 		if 'episodename' in episode:
@@ -75,8 +84,11 @@ def EpDataFromTVDB(context):
 			if 'firstaired' in episode:
 				d['airdate'] = episode['firstaired']
 			epdata[ep.index] = d
-	if frozenset(ep_mapping_found.keys()) != frozenset(ep_mapping.keys()):
-		raise RuntimeError('%s: Episode mapping had mappings for %r, but only found mappings for %r' % (context, ep_mapping.keys(), ep_mapping_found.keys()))
+	if ep_mapping:
+		mapped = frozenset(int(ep.index) for ep in episodes if ep.is_integer_ep)
+		unmatched.extend('index %s: no such episode' % (missing,) for missing in sorted(frozenset(ep_mapping.keys()) - mapped))
+		if unmatched:
+			raise RuntimeError('%s: Episode mapping has %d unmatched entries: %s' % (context, len(unmatched), '; '.join(unmatched)))
 	return epdata
 
 def EpDataFromHummingBird(context):
@@ -113,7 +125,7 @@ def GrabMetadata(context):
 			print('Warning: Cannot get metadata for', context, 'as no TVDB ID is assigned.')
 			return
 		tvdb = int(context.Get(data.TVDB.KEY))
-		show = data.TVDB.API[tvdb]
+		show = data.TVDB.GetShow(tvdb)
 		metadata = {
 			'source': 'tvdb:%d' % (tvdb,),
 			'summary': show.data['overview'],
@@ -147,9 +159,62 @@ def GrabMetadata(context):
 		metadata['retrieved'] = time.strftime('%Y-%m-%d')
 		context.SetMetadata(metadata)
 
+def _ReadChunks(path):
+	with open(path, 'rb') as f:
+		yield from iter(lambda: f.read(_ART_CHUNK_SIZE), b'')
+
+def _DownloadArt(context, source, filename, directory):
+	"""Streams source into a temporary file in directory. Returns its path, the extension of its content and its SHA-256 digest.
+
+	Raises webcache.OfflineError rather than downloading a URL in offline mode."""
+	if '://' in source and webcache.Cache().offline:
+		raise webcache.OfflineError('Offline mode: not downloading %s' % (source,))
+	handle, temporary = data.makeTemporary(directory, '.%s.' % (filename,), _PARTIAL_SUFFIX)
+	try:
+		with os.fdopen(handle, 'wb') as f:
+			contentType = None
+			try:
+				response = httpclient.Get(source, stream=True)
+				contentType = response.headers.get('content-type')
+				chunks = response.iter_content(_ART_CHUNK_SIZE)
+			except requests.exceptions.MissingSchema:
+				# No schema specified, so it must be a local file.
+				chunks = _ReadChunks(os.path.join(context.path, source))
+			head = b''
+			digest = hashlib.sha256()
+			for chunk in chunks:
+				if len(head) < _SNIFF_SIZE:
+					head += chunk[:_SNIFF_SIZE - len(head)]
+				digest.update(chunk)
+				f.write(chunk)
+			f.flush()
+			os.fsync(f.fileno())
+		extension = data.sniffImageExtension(head)
+		if extension is None and contentType:
+			extension = (mimetypes.guess_extension(contentType.split(';')[0].strip()) or '').lower().lstrip('.')
+		return temporary, data.imageExtensionMappings.get(extension, extension), digest.hexdigest()
+	except BaseException:
+		os.remove(temporary)
+		raise
+
+def _StoreArt(context, store, source, filename):
+	"""Returns the path of the store object holding source, downloading it only if the store does not have it yet. None if it is not an image."""
+	isURL = '://' in source
+	with store.URLLock(source):
+		objectPath = store.Lookup(source) if isURL else None
+		if objectPath is not None:
+			return objectPath
+		temporary, extension, digest = _DownloadArt(context, source, filename, store.temporary_path)
+		if extension not in data.imageExtensions:
+			os.remove(temporary)
+			print('Warning:', source, 'maps to unknown extension', extension)
+			return None
+		return store.Add(temporary, digest, extension, url=source if isURL else None)
+
 def GrabArt(context):
 	if context.kind in (data.Context.KIND_SOUNDTRACK, data.Context.KIND_IGNORE):
 		return
+	store = artstore.ForContext(context)
 	for key, filename in data.artResourceFilenames.items():
 		if key not in context.expected_art:
 			continue
@@ -159,30 +224,114 @@ def GrabArt(context):
 			continue
 		if any(os.path.isfile(os.path.join(context.path, filename + '.' + ext)) for ext in data.imageExtensions):
 			continue
+		for stale in glob.glob(os.path.join(glob.escape(context.path), '.%s.*%s' % (glob.escape(filename), _PARTIAL_SUFFIX))):
+			print('Removing partial download', stale)
+			os.remove(stale)
 		try:
-			request = requests.get(source)
-			extension = mimetypes.guess_extension(request.headers['content-type']).lower().lstrip('.')
-			content = request.content
-		except requests.exceptions.MissingSchema:
-			# No schema specified, so it must be a local file.
-			f = open(os.path.join(context.path, source), 'rb')
-			content = f.read()
-			f.close()
-			extension = imghdr.what(None, h=content)
-		extension = data.imageExtensionMappings.get(extension, extension)
-		if extension not in data.imageExtensions:
-			print('Warning:', source, 'maps to unknown extension', extension)
+			if store is None:
+				temporary, extension, _ = _DownloadArt(context, source, filename, context.path)
+			else:
+				objectPath = _StoreArt(context, store, source, filename)
+		except webcache.OfflineError as e:
+			print('Warning: Skipping %s of %s: %s' % (key, context, e))
 			continue
+		if store is None:
+			if extension not in data.imageExtensions:
+				os.remove(temporary)
+				print('Warning:', source, 'maps to unknown extension', extension)
+				continue
+		else:
+			if objectPath is None:
+				continue
+			extension = objectPath.rsplit('.', 1)[1]
 		target = os.path.join(context.path, filename + '.' + extension)
 		assert not os.path.exists(target)
-		f = open(target, 'wb')
-		f.write(content)
-		f.close()
+		if store is None:
+			os.replace(temporary, target)
+		else:
+			store.LinkTo(objectPath, target)
 		print('Grabbed', source, 'to', target)
 
+def Grab(context):
+	print('Grabbing:', context)
+	GrabMetadata(context)
+	GrabArt(context)
+
+def ConfigureCache(paths, offline=False):
+	"""Keeps HTTP responses and TVDB shows in the state directory of the first library found among paths."""
+	return data.configureCaches(paths, offline=offline)
+
+def PrefetchTVDB(paths, indexed=False):
+	"""Fetches the missing or stale TVDB shows of every directory under paths in parallel, ahead of grabbing them one at a time.
+
+	If indexed, the shows are those of the contexts IndexedContexts yields, read from the library index rather than by walking paths."""
+	ids = set()
+	for path in paths:
+		index = libindex.ForPath(path) if indexed else None
+		if index is not None:
+			ids.update(int(tvdb) for tvdb in index.SourceIDs(data.TVDB, _IndexedPaths(index, path)) if tvdb.isdigit())
+			continue
+		for _, info in data.Discover(path):
+			for section in info.values():
+				tvdb = section.get(data.TVDB.KEY) if isinstance(section, dict) else None
+				if tvdb is not None and str(tvdb).isdigit():
+					ids.add(int(tvdb))
+	fetched, failed = tvdbcache.Prefetch(ids)
+	if fetched:
+		print('Prefetched %d of %d TVDB shows.' % (fetched, len(ids)))
+	if failed:
+		print('Warning: Could not prefetch %d of %d TVDB shows.' % (failed, len(ids)))
+
+def _IndexedPaths(index, path):
+	"""Returns the sorted paths of the contexts under path that index says lack metadata or art."""
+	kinds = (data.Context.KIND_SERIES, data.Context.KIND_SEASON, data.Context.KIND_MOVIE, data.Context.KIND_OVA)
+	paths = set()
+	for lacking in ('metadata',) + tuple(data.artResourceFilenames):
+		paths.update(index.Query(kinds=kinds, lacking=(lacking,), under=path))
+	# Sorted paths put series before their seasons, as Traverse does.
+	return sorted(paths)
+
+def IndexedContexts(path, refresh=True):
+	"""Yields the Contexts under path that the library index says lack metadata or art, in traversal order, refreshing the index first
+	unless refresh is False."""
+	index = libindex.ForPath(path)
+	if index is None:
+		print('Warning: No library index for', path, 'as it is not in a media library; traversing it instead.')
+		yield from data.Traverse(path)
+		return
+	if refresh:
+		index.Refresh()
+	yield from index.Contexts(_IndexedPaths(index, path))
+
 if __name__ == '__main__':
-	for path in sys.argv[1:]:
-		for context in data.Traverse(path):
-			print('Grabbing:', context)
-			GrabMetadata(context)
-			GrabArt(context)
+	parser = argparse.ArgumentParser(description='Grab metadata and art for media directories.')
+	parser.add_argument('--offline', action='store_true', help='Only use cached HTTP responses; never hit the network.')
+	parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of contexts to grab concurrently.')
+	parser.add_argument('--index', action='store_true', help='Only grab contexts the library index lists as lacking metadata or art.')
+	parser.add_argument('--normalize-art', action='store_true', help='Scale down and recompress grabbed art for Kodi (see normalize-art.py).')
+	parser.add_argument('paths', nargs='+')
+	args = parser.parse_args()
+	ConfigureCache(args.paths, offline=args.offline)
+	if args.index:
+		for path in args.paths:
+			index = libindex.ForPath(path)
+			if index is not None:
+				index.Refresh()
+	PrefetchTVDB(args.paths, indexed=args.index)
+	grab = Grab
+	normalizer = None
+	if args.normalize_art:
+		normalizer = importlib.import_module('normalize-art').ArtNormalizer()
+		def grab(context):
+			Grab(context)
+			normalizer.Normalize(context)
+	try:
+		for path in args.paths:
+			# Contexts with subcontexts are grabbed before those are created, as those copy their data.
+			contexts = IndexedContexts(path, refresh=False) if args.index else data.Traverse(path)
+			for _ in parallel.OrderedMap(grab, contexts, args.jobs, sequential=lambda context: context.has_subcontexts):
+				pass
+	finally:
+		if normalizer is not None:
+			normalizer.Close()
+	httpclient.PrintStats()
@@ -0,0 +1,147 @@
+import random
+import threading
+import time
+import urllib.parse
+
+BROWSER_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2062.120 Safari/537.36'
+DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+POOL_SIZE = 8
+MAX_CONCURRENT_PER_HOST = 4
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+# Token bucket parameters (requests per second, burst size) by Source.KEY. Requests not tied to a source are limited per host with the None entry.
+RATES = {
+	'tvdb': (2.0, 4),
+	'hummingbird': (2.0, 4),
+	'mal': (0.25, 1), # Incapsula trips on bursts.
+	'anidb': (0.5, 1),
+	'imdb': (1.0, 2),
+	None: (4.0, 8),
+}
+
+class TokenBucket(object):
+	def __init__(self, rate, burst):
+		self._rate = rate
+		self._burst = burst
+		self._tokens = float(burst)
+		self._updated = time.monotonic()
+		self._lock = threading.Lock()
+
+	def Acquire(self):
+		"""Blocks until a token is available, then takes it."""
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				self._tokens = min(float(self._burst), self._tokens + (now - self._updated) * self._rate)
+				self._updated = now
+				if self._tokens >= 1:
+					self._tokens -= 1
+					return
+				wait = (1 - self._tokens) / self._rate
+			time.sleep(wait)
+
+class HostStats(object):
+	def __init__(self, host):
+		self.host = host
+		self.requests = 0
+		self.retries = 0
+		self.bytes = 0
+		self.seconds = 0.0
+
+	def __str__(self):
+		return '%s: %d requests (%d retries), %d bytes, %.2fs' % (self.host, self.requests, self.retries, self.bytes, self.seconds)
+
+class Client(object):
+	"""HTTP client shared by all Sources and tools: one keep-alive session per host with a bounded number of concurrent requests,
+	rate limits per source, retries with jittered exponential backoff, default timeouts and per-host counters."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._sessions = {}
+		self._slots = {}
+		self._buckets = {}
+		self._stats = {}
+
+	def _Session(self, host):
+		with self._lock:
+			session = self._sessions.get(host)
+			if session is None:
+				import requests.adapters # Deferred, as most tools importing this module never make a request.
+				session = requests.Session()
+				adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+				session.mount('http://', adapter)
+				session.mount('https://', adapter)
+				self._sessions[host] = session
+				self._slots[host] = threading.BoundedSemaphore(MAX_CONCURRENT_PER_HOST)
+			return session, self._slots[host]
+
+	def _Bucket(self, source, host):
+		key = source if source in RATES else (None, host)
+		with self._lock:
+			bucket = self._buckets.get(key)
+			if bucket is None:
+				bucket = self._buckets[key] = TokenBucket(*RATES.get(source, RATES[None]))
+			return bucket
+
+	def _Stats(self, host):
+		with self._lock:
+			stats = self._stats.get(host)
+			if stats is None:
+				stats = self._stats[host] = HostStats(host)
+			return stats
+
+	@staticmethod
+	def _Backoff(attempt, response=None):
+		if response is not None and response.headers.get('retry-after', '').isdigit():
+			return min(BACKOFF_MAX, float(response.headers['retry-after']))
+		return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+	def Get(self, url, source=None, headers=None, timeout=DEFAULT_TIMEOUT, stream=False, **kwargs):
+		"""GETs url, retrying connection errors and throttling statuses. Returns the last requests.Response."""
+		import requests
+		host = urllib.parse.urlsplit(url).netloc
+		session, slots = self._Session(host)
+		bucket = self._Bucket(source, host)
+		stats = self._Stats(host)
+		attempt = 0
+		while True:
+			bucket.Acquire()
+			start = time.monotonic()
+			response = None
+			try:
+				with slots:
+					response = session.get(url, headers=headers, timeout=timeout, stream=stream, **kwargs)
+			except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+				if attempt >= MAX_RETRIES:
+					raise
+			with self._lock:
+				stats.requests += 1
+				stats.retries += 1 if attempt else 0
+				stats.seconds += time.monotonic() - start
+				if response is not None:
+					stats.bytes += int(response.headers.get('content-length', 0)) if stream else len(response.content)
+			if response is not None and (response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES):
+				return response
+			if response is not None:
+				response.close() # Otherwise a streamed response keeps its connection out of the pool.
+			time.sleep(self._Backoff(attempt, response))
+			attempt += 1
+
+	def Stats(self):
+		with self._lock:
+			return list(sorted(self._stats.values(), key=lambda s: s.host))
+
+	def PrintStats(self):
+		for stats in self.Stats():
+			if stats.requests:
+				print('HTTP:', stats)
+
+_client = Client()
+
+def Get(url, source=None, headers=None, timeout=DEFAULT_TIMEOUT, stream=False, **kwargs):
+	return _client.Get(url, source=source, headers=headers, timeout=timeout, stream=stream, **kwargs)
+
+def PrintStats():
+	_client.PrintStats()
@@ -0,0 +1,117 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+class Event(object):
+	def __init__(self, directory, name, mask, cookie):
+		self._directory = directory
+		self._name = name
+		self._mask = mask
+		self._cookie = cookie
+
+	@property
+	def directory(self):
+		return self._directory
+	@property
+	def name(self):
+		return self._name
+	@property
+	def path(self):
+		return os.path.join(self.directory, self.name) if self.name else self.directory
+	@property
+	def mask(self):
+		return self._mask
+	@property
+	def cookie(self):
+		return self._cookie
+	@property
+	def is_dir(self):
+		return bool(self.mask & IN_ISDIR)
+	@property
+	def is_overflow(self):
+		return bool(self.mask & IN_Q_OVERFLOW)
+
+	def __str__(self):
+		return 'Event<%s %#x>' % (self.path, self.mask)
+
+class Watcher(object):
+	"""Minimal Linux inotify binding through ctypes."""
+
+	def __init__(self):
+		self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+		if self._fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1: %s' % (os.strerror(ctypes.get_errno()),))
+		self._directories = {}
+
+	def Add(self, path, mask):
+		wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_add_watch %s: %s' % (path, os.strerror(ctypes.get_errno())))
+		self._directories[wd] = path
+		return wd
+
+	def AddTree(self, path, mask, skip=()):
+		"""Watches path and all directories below it, except those named in skip."""
+		for directory, subdirectories, _ in os.walk(path):
+			subdirectories[:] = [d for d in subdirectories if d not in skip]
+			try:
+				self.Add(directory, mask | IN_ONLYDIR)
+			except FileNotFoundError:
+				pass # Removed while walking.
+
+	def Read(self, timeout=None):
+		"""Returns the pending events, waiting up to timeout seconds (forever if None) for some to arrive."""
+		ready, _, _ = select.select((self._fd,), (), (), timeout)
+		if not ready:
+			return []
+		buffer = os.read(self._fd, _READ_SIZE)
+		events = []
+		offset = 0
+		while offset < len(buffer):
+			wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buffer, offset)
+			offset += _EVENT_HEADER.size
+			name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+			offset += length
+			if mask & IN_IGNORED:
+				self._directories.pop(wd, None)
+				continue
+			events.append(Event(self._directories.get(wd, ''), name, mask, cookie))
+		return events
+
+	def ReadDebounced(self, quiet, limit):
+		"""Waits for events, then keeps collecting them until none arrived for quiet seconds or limit seconds went by. Returns them all."""
+		events = self.Read()
+		deadline = time.monotonic() + limit
+		while True:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				return events
+			more = self.Read(min(quiet, remaining))
+			if not more:
+				return events
+			events.extend(more)
+
+	def Close(self):
+		os.close(self._fd)
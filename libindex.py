@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import data
+
+indexFile = 'library-index.sqlite'
+_SOURCES = (data.AniDB, data.MAL, data.TVDB, data.IMDB, data.HummingBird)
+_ART = tuple(sorted(data.artResourceFilenames))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS contexts (
+	path TEXT PRIMARY KEY,
+	parent TEXT,
+	kind TEXT,
+	name TEXT,
+	signature TEXT NOT NULL,
+	keys TEXT NOT NULL,
+	%s,
+	has_metadata INTEGER NOT NULL,
+	%s,
+	episodes INTEGER,
+	refreshed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contexts_kind ON contexts (kind);
+CREATE TABLE IF NOT EXISTS episodes (
+	context TEXT NOT NULL,
+	filename TEXT NOT NULL,
+	number TEXT NOT NULL,
+	PRIMARY KEY (context, filename)
+);
+""" % (
+	',\n\t'.join('%s TEXT' % (source.KEY,) for source in _SOURCES),
+	',\n\t'.join('%s INTEGER' % (art,) for art in _ART),
+)
+
+class LibraryIndex(object):
+	"""SQLite index of the Contexts of a library, kept in its state directory.
+
+	Each context row holds its kind, merged keys (minus www_metadata), source IDs, whether it has metadata of its own, and for each art
+	type whether it is present (1), missing (0) or not expected (NULL). Rows are only rebuilt when the signature of the directory changes:
+	its own .info and directory mtimes, and the signature of its parent, as keys are inherited."""
+
+	_INSTANCES = {}
+	_INSTANCES_LOCK = threading.Lock()
+
+	@classmethod
+	def ForRoot(cls, root):
+		"""Returns the LibraryIndex of the library at root, without reading its .root file (see data.SidecarCache.ForRoot)."""
+		with cls._INSTANCES_LOCK:
+			index = cls._INSTANCES.get(root)
+			if index is None:
+				index = cls._INSTANCES[root] = cls(root)
+			return index
+
+	def __init__(self, root):
+		self._root = root
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(data.statePath(root, indexFile), check_same_thread=False)
+		self._conn.executescript(_SCHEMA)
+		self._conn.commit()
+
+	@property
+	def root(self):
+		return self._root
+
+	@staticmethod
+	def _Signature(parentSignature, directory):
+		info = os.stat(os.path.join(directory, data.infoFile))
+		return hashlib.sha1(json.dumps([parentSignature, info.st_mtime_ns, info.st_size, os.stat(directory).st_mtime_ns]).encode('utf-8')).hexdigest()
+
+	def _Store(self, context, parent, signature):
+		files = frozenset(context.filenames)
+		art = [
+			None if a not in context.expected_art else int(any('%s.%s' % (data.artResourceFilenames[a], ext) in files for ext in data.imageExtensions))
+			for a in _ART
+		]
+		episodes = None
+		if context.kind in (context.KIND_SEASON, context.KIND_OVA):
+			episodes = [(context.path, ep.filename, str(ep.index)) for ep in context.episodes]
+		keys = {k: context.Get(k) for k in context.KNOWN_KEYS if k != 'www_metadata' and context.Get(k) is not None}
+		ids = [None if context.Get(source.KEY) is None else str(context.Get(source.KEY)) for source in _SOURCES]
+		self._conn.execute('INSERT OR REPLACE INTO contexts (path, parent, kind, name, signature, keys, %s, has_metadata, %s, episodes, refreshed) VALUES (%s)' % (
+			', '.join(source.KEY for source in _SOURCES), ', '.join(_ART), ', '.join('?' * (9 + len(_SOURCES) + len(_ART))),
+		), [
+			context.path, parent, context.kind, context.Get('name'), signature, json.dumps(keys, default=str, sort_keys=True),
+		] + ids + [int(bool(context.metadata_single))] + art + [None if episodes is None else len(episodes), time.time()])
+		self._conn.execute('DELETE FROM episodes WHERE context = ?', (context.path,))
+		if episodes:
+			self._conn.executemany('INSERT INTO episodes (context, filename, number) VALUES (?, ?, ?)', episodes)
+
+	def Refresh(self):
+		"""Brings the index up to date with the library, only building Contexts for directories whose signature changed. Returns (updated, removed)."""
+		with self._lock:
+			known = dict(self._conn.execute('SELECT path, signature FROM contexts'))
+			base = data.Context(None, self.root)
+			stack = [] # [directory, info, signature, Context or None] for the directory and its ancestors.
+			def materialize(i):
+				if stack[i][3] is None:
+					stack[i][3] = (materialize(i - 1) if i else base).SubContext(stack[i][0], stack[i][1])
+				return stack[i][3]
+			seen = set()
+			updated = 0
+			for directory, info in data.Discover(self.root):
+				while stack and not directory.startswith(stack[-1][0] + os.sep):
+					stack.pop()
+				signature = self._Signature(stack[-1][2] if stack else None, directory)
+				stack.append([directory, info, signature, None])
+				seen.add(directory)
+				if known.get(directory) != signature:
+					self._Store(materialize(len(stack) - 1), stack[-2][0] if len(stack) > 1 else None, signature)
+					updated += 1
+			removed = [path for path in known if path not in seen]
+			self._conn.executemany('DELETE FROM contexts WHERE path = ?', ((path,) for path in removed))
+			self._conn.executemany('DELETE FROM episodes WHERE context = ?', ((path,) for path in removed))
+			self._conn.commit()
+		return updated, len(removed)
+
+	def Query(self, kinds=(), lacking=(), under=None):
+		"""Returns the sorted paths of indexed contexts of one of kinds (any kind if empty), under the directory under (if given), that lack
+		everything in lacking: source keys, art types, or 'metadata'."""
+		conditions = []
+		parameters = []
+		if kinds:
+			conditions.append('kind IN (%s)' % (', '.join('?' * len(kinds)),))
+			parameters.extend(kinds)
+		for what in lacking:
+			if what == 'metadata':
+				conditions.append('has_metadata = 0')
+			elif what in _ART:
+				conditions.append('%s = 0' % (what,))
+			elif what in [source.KEY for source in _SOURCES]:
+				conditions.append('%s IS NULL' % (what,))
+			else:
+				raise RuntimeError('%s: Cannot query for contexts lacking %r' % (self, what))
+		if under is not None:
+			under = os.path.abspath(under)
+			conditions.append('(path = ? OR substr(path, 1, ?) = ?)')
+			parameters.extend((under, len(under) + 1, under + os.sep))
+		with self._lock:
+			rows = self._conn.execute('SELECT path FROM contexts%s ORDER BY path' % (' WHERE ' + ' AND '.join(conditions) if conditions else '',), parameters)
+			return [path for path, in rows]
+
+	def SourceIDs(self, source, paths):
+		"""Returns the distinct IDs of source (as strings) that the indexed contexts at paths have."""
+		paths = frozenset(paths)
+		with self._lock:
+			rows = self._conn.execute('SELECT path, %s FROM contexts WHERE %s IS NOT NULL' % (source.KEY, source.KEY)).fetchall()
+		return {id for path, id in rows if path in paths}
+
+	def Episodes(self, path):
+		"""Returns the indexed (number, filename) pairs of the season or OVA at path."""
+		with self._lock:
+			return self._conn.execute('SELECT number, filename FROM episodes WHERE context = ? ORDER BY filename', (path,)).fetchall()
+
+	def Contexts(self, paths):
+		"""Yields the Context of each of paths, as Traverse would have built it from the library root."""
+		for path in paths:
+			yield data.LoadContext(self.root, path)
+
+	def __str__(self):
+		return 'LibraryIndex<%s>' % (self.root,)
+
+def ForPath(path):
+	"""Returns the LibraryIndex of the library path is in, or None if it is not in a library."""
+	root = data.findRoot(os.path.abspath(path))
+	if root is None:
+		return None
+	return LibraryIndex.ForRoot(root)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Maintain and query the index of media libraries.')
+	parser.add_argument('command', choices=('refresh', 'query'))
+	parser.add_argument('--kind', action='append', default=[], help='Only list contexts of this kind (repeatable).')
+	parser.add_argument('--lacking', action='append', default=[], help='Only list contexts lacking this source ID, art type or "metadata" (repeatable).')
+	parser.add_argument('--no-refresh', action='store_true', help='Query the index as it is, without refreshing it first.')
+	parser.add_argument('paths', nargs='+', help='Paths inside media libraries.')
+	args = parser.parse_args()
+	for path in args.paths:
+		index = ForPath(path)
+		if index is None:
+			print('Warning: Skipping', path, 'as it is not in a media library.')
+			continue
+		if args.command == 'refresh' or not args.no_refresh:
+			updated, removed = index.Refresh()
+			if args.command == 'refresh':
+				print('Updated %d and removed %d contexts in %s.' % (updated, removed, index))
+		if args.command == 'query':
+			for result in index.Query(kinds=args.kind, lacking=args.lacking, under=path):
+				print(result)
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
+import argparse
+import hashlib
+import json
 import os
 import shutil
-import sys
+import threading
 import data
+import inotify
 from xml.sax.saxutils import escape as xml_escape
 
 _TVSHOW_TEMPLATE = """
@@ -53,6 +57,43 @@ _MOVIE_TEMPLATE = """
 </movie>
 """
 
+manifestFile = 'reflection-manifest.json'
+_WATCH_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+_WATCH_QUIET_SECONDS = 5
+_WATCH_MAX_SECONDS = 60
+_MANIFESTS_LOCK = threading.Lock()
+
+class ReflectionManifest(data.SidecarCache):
+	"""Records, for each context, the mtimes of its directory and .info, whether its reflected directory exists, and a digest of its data as
+	of the last time it was reflected. A context whose record still matches can be skipped, and need not even be sanity checked."""
+
+	FILENAME = manifestFile
+	VERSION = 4
+	# Changing the templates changes every NFO, so they are part of every digest.
+	_TEMPLATES_DIGEST = hashlib.sha256(''.join((_TVSHOW_TEMPLATE, _SEASON_TEMPLATE, _EPISODE_TEMPLATE, _MOVIE_TEMPLATE)).encode('utf-8')).hexdigest()
+
+	@staticmethod
+	def _MTime(path):
+		return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+	def _State(self, context):
+		inputs = json.dumps([
+			self._TEMPLATES_DIGEST, context.kind, context.reflected_root,
+			context.series, context.season, context.movie, context.ova, context.soundtrack,
+		], sort_keys=True, default=str)
+		return {
+			'path': self._MTime(context.path),
+			'info': self._MTime(context.info_path),
+			'reflected': os.path.isdir(context.reflected_path),
+			'digest': hashlib.sha256(inputs.encode('utf-8')).hexdigest(),
+		}
+
+	def IsUnchanged(self, context):
+		return self._Get(context.path) == self._State(context)
+
+	def Record(self, context):
+		self._Set(context.path, self._State(context))
+
 def _CleanupNFO(data):
 	return data.strip().replace('\r', '')
 
@@ -140,13 +181,122 @@ def DeleteNonInspected(context, inspected):
 				print('rm', f)
 				os.remove(f)
 
+def Reflect(context):
+	print('Making reflected version:', context)
+	inspected = set()
+	for f in MakeReflection(context):
+		inspected.add(f)
+	for f in MakeNFO(context):
+		inspected.add(f)
+	DeleteNonInspected(context, inspected)
+
+def ManifestFor(context, manifests):
+	"""Returns the ReflectionManifest of context's library, loading it into manifests on first use."""
+	with _MANIFESTS_LOCK:
+		if context.root not in manifests:
+			manifests[context.root] = ReflectionManifest.ForRoot(context.root)
+		return manifests[context.root]
+
+def SaveState(manifests):
+	"""Saves the reflection manifests, NFO indexes and InfoCaches of the libraries in manifests. Watch calls this after every batch, so that
+	a long-running watch that is killed loses at most a batch of work."""
+	for root, manifest in manifests.items():
+		manifest.Save()
+		data.NFOIndex.ForRoot(root).Save()
+		data.InfoCache.ForRoot(root).Save()
+
+def ReflectIfChanged(context, manifests, full=False):
+	"""Reflects context unless its manifest record shows it unchanged. Only contexts that are reflected are sanity checked, so that
+	traversals for this can leave checking out."""
+	manifest = ManifestFor(context, manifests)
+	if not full and manifest.IsUnchanged(context):
+		return
+	context.sanityCheck()
+	Reflect(context)
+	manifest.Record(context)
+
+def ReflectTree(base, directory, manifests):
+	"""Reflects the context owning directory and all contexts below it, as Traverse(base) would find them."""
+	if not os.path.isdir(directory):
+		return
+	owner = directory
+	while owner != base and not os.path.isfile(os.path.join(owner, data.infoFile)):
+		owner = os.path.dirname(owner)
+	if os.path.isfile(os.path.join(owner, data.infoFile)):
+		directory = owner
+		parent = data.LoadContext(base, os.path.dirname(owner)) if owner != base else data.Context(None, base)
+	else:
+		# Nothing owns directory (it is the library root, or a directory a series was moved into), so the contexts below it hang off the
+		# base, as in Traverse(base).
+		parent = data.Context(None, base)
+	for context in data.traverse(directory, parent, check=False):
+		ReflectIfChanged(context, manifests)
+
+def _IsRelevant(event):
+	if event.is_overflow or event.is_dir:
+		return True
+	return event.name == data.infoFile or not event.name.startswith('.') # Hidden files are partial downloads and the like.
+
+def Watch(paths, manifests):
+	"""Watches paths with inotify and reflects affected contexts as files land, after bursts of changes settle down."""
+	bases = list(map(os.path.abspath, paths))
+	watcher = inotify.Watcher()
+	for base in bases:
+		watcher.AddTree(base, _WATCH_MASK, skip=(data.stateDirectory,))
+	print('Watching', ', '.join(bases))
+	try:
+		while True:
+			changed = set()
+			overflowed = False
+			for event in watcher.ReadDebounced(_WATCH_QUIET_SECONDS, _WATCH_MAX_SECONDS):
+				if event.is_overflow:
+					overflowed = True
+					continue
+				if not _IsRelevant(event):
+					continue
+				if event.is_dir and event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO) and os.path.isdir(event.path):
+					watcher.AddTree(event.path, _WATCH_MASK, skip=(data.stateDirectory,))
+				changed.add(event.directory)
+			if overflowed:
+				print('Warning: inotify queue overflowed; rescanning everything.')
+				for base in bases:
+					watcher.AddTree(base, _WATCH_MASK, skip=(data.stateDirectory,)) # Directories created meanwhile went unnoticed.
+					try:
+						for context in data.Traverse(base, check=False):
+							ReflectIfChanged(context, manifests)
+					except RuntimeError as e:
+						print('Error while reflecting %s: %s' % (base, e))
+				changed = set()
+			for directory in sorted(changed):
+				# Subtrees of directories already handled in this round are covered by them.
+				if any(directory.startswith(other + os.sep) for other in changed):
+					continue
+				for base in bases:
+					if directory == base or directory.startswith(base + os.sep):
+						try:
+							ReflectTree(base, directory, manifests)
+						except RuntimeError as e:
+							print('Error while reflecting %s: %s' % (directory, e))
+			SaveState(manifests)
+	finally:
+		watcher.Close()
+
 if __name__ == '__main__':
-	for path in sys.argv[1:]:
-		for context in data.Traverse(path):
-			print('Making reflected version:', context)
-			inspected = set()
-			for f in MakeReflection(context):
-				inspected.add(f)
-			for f in MakeNFO(context):
-				inspected.add(f)
-			DeleteNonInspected(context, inspected)
+	parser = argparse.ArgumentParser(description='Make the reflected version of media directories, with symlinks and NFO files for Kodi.')
+	parser.add_argument('--full', action='store_true', help='Reflect every context, even those unchanged since the last run.')
+	parser.add_argument('--watch', action='store_true', help='After the initial pass, keep watching for changes and reflect them as they happen.')
+	parser.add_argument('paths', nargs='+')
+	args = parser.parse_args()
+	manifests = {}
+	try:
+		for path in args.paths:
+			for context in data.Traverse(path, check=False):
+				ReflectIfChanged(context, manifests, full=args.full)
+		if args.watch:
+			SaveState(manifests)
+			Watch(args.paths, manifests)
+	except KeyboardInterrupt:
+		if not args.watch:
+			raise
+	finally:
+		SaveState(manifests)
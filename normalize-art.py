@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import hashlib
+import importlib
+import multiprocessing
+import os
+import shutil
+import threading
+import artstore
+import data
+
+verifyArt = importlib.import_module('verify-art')
+
+indexFile = 'art-normalized.json'
+backupDirectory = 'art-originals'
+NORMALIZE_JOBS = os.cpu_count() or 1
+QUALITY = 88
+
+# Largest (width, height) Kodi needs for each kind of art; larger art is scaled down to fit, keeping its ratio.
+targetSizes = {
+	'poster': (1000, 1500),
+	'background': (1920, 1080),
+	'banner': (1000, 185),
+}
+
+def _Digest(path):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def _Normalize(source, destination, size, quality):
+	"""Writes the image at source to destination as a JPEG that fits in size. Runs in a worker process. Returns the (width, height) written."""
+	from PIL import Image # Only needed by the worker processes, and slow to import.
+	with Image.open(source) as image:
+		image.draft('RGB', size) # Lets large JPEGs be decoded at a fraction of their size.
+		if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+			image = image.convert('RGBA')
+			flattened = Image.new('RGB', image.size, (0, 0, 0))
+			flattened.paste(image, mask=image.getchannel('A'))
+			image = flattened
+		elif image.mode != 'RGB':
+			image = image.convert('RGB')
+		image.thumbnail(size, Image.LANCZOS)
+		image.save(destination, 'JPEG', quality=quality, optimize=True, progressive=True)
+		return image.size
+
+class NormalizationIndex(data.SidecarCache):
+	"""Records the digest of every art file written or accepted as normalized, along with the digest of the original it came from, whose
+	backup is kept in the state directory. Files are digested at most once per size and mtime."""
+
+	FILENAME = indexFile
+
+	def __init__(self, path=None):
+		self._normalized = {}
+		super(NormalizationIndex, self).__init__(path)
+
+	def _Restore(self, state):
+		self._normalized = state['normalized']
+		self._entries = state['files']
+
+	def _Snapshot(self):
+		state = super(NormalizationIndex, self)._Snapshot()
+		return {'version': state['version'], 'normalized': dict(self._normalized), 'files': state['entries']}
+
+	def Digest(self, art_path):
+		return self._Validated(art_path, _Digest)
+
+	def IsNormalized(self, digest):
+		with self._lock:
+			return digest in self._normalized
+
+	def Record(self, digest, original):
+		with self._lock:
+			self._normalized[digest] = original
+			self._dirty = True
+
+class ArtNormalizer(object):
+	"""Scales art down to targetSizes and recompresses it as JPEG on up to jobs worker processes.
+
+	The original of every normalized file is kept in the library's state directory, named after its digest; art in the art store is
+	hardlinked there rather than copied, which also keeps it from being garbage collected. Normalized files are added to the art store."""
+
+	def __init__(self, jobs=NORMALIZE_JOBS):
+		# Worker processes are spawned rather than forked, as the callers run threads that may hold locks.
+		self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+		self._lock = threading.Lock()
+		self._indexes = set()
+
+	def _IndexFor(self, root):
+		index = NormalizationIndex.ForRoot(root)
+		with self._lock:
+			self._indexes.add(index)
+		return index
+
+	@staticmethod
+	def _Backup(root, path, digest):
+		backup = os.path.join(data.statePath(root, backupDirectory), '%s.%s' % (digest, path.rsplit('.', 1)[1]))
+		if not os.path.exists(backup):
+			os.makedirs(os.path.dirname(backup), exist_ok=True)
+			try:
+				os.link(path, backup)
+			except OSError:
+				shutil.copyfile(path, backup)
+		return backup
+
+	def Normalize(self, context):
+		"""Normalizes the art of context, waiting for the worker processes to finish. Returns the number of files normalized."""
+		index = self._IndexFor(context.root)
+		store = artstore.ForContext(context)
+		files = frozenset(context.filenames)
+		pending = []
+		for art, filename in sorted(data.artResourceFilenames.items()):
+			for ext in data.imageExtensions:
+				path = os.path.join(context.path, filename + '.' + ext)
+				if filename + '.' + ext not in files:
+					continue
+				digest = index.Digest(path)
+				if index.IsNormalized(digest):
+					continue
+				try:
+					width, height = verifyArt.ImageSize(path)
+				except Exception as e:
+					print('Warning: Cannot read %s of %s: %s: %s' % (art, context, path, e))
+					continue
+				if ext == 'jpg' and width <= targetSizes[art][0] and height <= targetSizes[art][1]:
+					index.Record(digest, digest) # Recompressing would only lose quality.
+					continue
+				directory = store.temporary_path if store is not None else context.path
+				handle, temporary = data.makeTemporary(directory, '.%s.' % (filename,), '.jpg')
+				os.close(handle)
+				pending.append((art, filename, path, digest, temporary, self._executor.submit(_Normalize, path, temporary, targetSizes[art], QUALITY)))
+		normalized = 0
+		for art, filename, path, digest, temporary, future in pending:
+			try:
+				width, height = future.result()
+			except Exception as e:
+				os.remove(temporary)
+				print('Warning: Cannot normalize %s of %s: %s: %s' % (art, context, path, e))
+				continue
+			self._Backup(context.root, path, digest)
+			target = os.path.join(context.path, filename + '.jpg')
+			normalizedDigest = _Digest(temporary)
+			if store is not None:
+				store.LinkTo(store.Add(temporary, normalizedDigest, 'jpg'), target)
+			else:
+				os.replace(temporary, target)
+			if target != path:
+				os.remove(path)
+			index.Record(normalizedDigest, digest)
+			print('Normalized %s to %dx%d: %s' % (path, width, height, target))
+			normalized += 1
+		return normalized
+
+	def Close(self):
+		"""Waits for the worker processes to exit and saves the indexes."""
+		self._executor.shutdown(wait=True)
+		for index in self._indexes:
+			index.Save()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Scale down and recompress the art of media directories for Kodi.')
+	parser.add_argument('--jobs', '-j', type=int, default=NORMALIZE_JOBS, help='Number of worker processes.')
+	parser.add_argument('paths', nargs='+')
+	args = parser.parse_args()
+	normalizer = ArtNormalizer(jobs=args.jobs)
+	try:
+		for path in args.paths:
+			for context in data.Traverse(path):
+				normalizer.Normalize(context)
+	finally:
+		normalizer.Close()
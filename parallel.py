@@ -0,0 +1,97 @@
+import collections
+import concurrent.futures
+import io
+import sys
+import threading
+
+class _ThreadOutput(object):
+	"""Stand-in for sys.stdout that sends what worker threads print to a per-thread buffer, so it can be replayed in order later."""
+
+	def __init__(self, stream):
+		self._stream = stream
+		self._local = threading.local()
+
+	@property
+	def stream(self):
+		return self._stream
+
+	def write(self, text):
+		return (getattr(self._local, 'buffer', None) or self._stream).write(text)
+
+	def flush(self):
+		if getattr(self._local, 'buffer', None) is None:
+			self._stream.flush()
+
+	def Capture(self, func, item):
+		"""Calls func(item) with this thread's output buffered. Returns (output, result, exception)."""
+		buffer = self._local.buffer = io.StringIO()
+		try:
+			result = func(item)
+		except Exception as e:
+			return buffer.getvalue(), None, e
+		finally:
+			self._local.buffer = None
+		return buffer.getvalue(), result, None
+
+	def __getattr__(self, name):
+		return getattr(self._stream, name)
+
+_END = object()
+
+def _Call(func, item):
+	"""Like _ThreadOutput.Capture, without capturing anything."""
+	try:
+		return '', func(item), None
+	except Exception as e:
+		return '', None, e
+
+def OrderedMap(func, items, jobs, sequential=None, lookahead=None, interactive=False):
+	"""Calls func on each of items using up to jobs threads, yielding results in the order of items.
+
+	Whatever func prints, and whatever is printed while producing each item, is buffered per item and replayed in that same order. If
+	sequential(item) is true, func(item) completes before the next item is taken from items, which matters when producing later items
+	depends on it. If interactive, what is printed while producing items is not buffered but written right away, so that prompts show up.
+	The first exception is re-raised once everything before it has been yielded."""
+	if jobs <= 1:
+		for item in items:
+			yield func(item)
+		return
+	lookahead = lookahead or jobs * 2
+	installed = not isinstance(sys.stdout, _ThreadOutput)
+	if installed:
+		sys.stdout = _ThreadOutput(sys.stdout)
+	output = sys.stdout
+	iterator = iter(items)
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+	pending = collections.deque()
+	def emit():
+		text, future = pending.popleft()
+		output.stream.write(text)
+		if future is None:
+			return _END
+		text, result, error = future.result()
+		output.stream.write(text)
+		if error is not None:
+			raise error
+		return result
+	try:
+		while True:
+			text, item, error = output.Capture(next, iterator) if not interactive else _Call(next, iterator)
+			if error is not None:
+				pending.append((text, None))
+				while pending:
+					result = emit()
+					if result is not _END:
+						yield result
+				if not isinstance(error, StopIteration):
+					raise error
+				return
+			pending.append((text, executor.submit(output.Capture, func, item)))
+			if sequential is not None and sequential(item):
+				concurrent.futures.wait((pending[-1][1],))
+			while pending and (len(pending) > lookahead or pending[0][1].done()):
+				yield emit()
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
+		if installed:
+			sys.stdout = output.stream
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import threading
+import time
+import data
+import httpclient
+import parallel
+
+# The tools are scripts with hyphenated names, so they are imported by name.
+assist = importlib.import_module('populate-assist')
+grab = importlib.import_module('grab')
+normalizeArt = importlib.import_module('normalize-art')
+verifyArt = importlib.import_module('verify-art')
+mkreflection = importlib.import_module('mkreflection')
+updateKodi = importlib.import_module('update-kodi')
+
+STAGES = ('assist', 'grab-metadata', 'grab-art', 'normalize-art', 'verify-art', 'reflect', 'kodi')
+DEFAULT_STAGES = ('assist', 'grab-metadata', 'grab-art', 'reflect')
+
+class StageTimer(object):
+	"""Accumulates the time spent in each stage across all contexts and threads."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._seconds = {}
+		self._counts = {}
+
+	def Add(self, stage, seconds):
+		with self._lock:
+			self._seconds[stage] = self._seconds.get(stage, 0.0) + seconds
+			self._counts[stage] = self._counts.get(stage, 0) + 1
+
+	def Run(self, stage, func, *args):
+		start = time.monotonic()
+		try:
+			return func(*args)
+		finally:
+			self.Add(stage, time.monotonic() - start)
+
+	def Print(self, wall):
+		for stage in STAGES + ('traverse',):
+			if stage in self._counts:
+				print('%-14s %6d contexts %9.2fs' % (stage, self._counts[stage], self._seconds[stage]))
+		print('%-14s %16s %9.2fs' % ('total', '', wall))
+
+class Pipeline(object):
+	"""Pushes every Context of a single traversal through the enabled stages.
+
+	The interactive assist stage runs on the traversing thread, as it prompts for input and may rewrite the .info files of contexts before
+	their subcontexts are created. The other stages of a context run one after the other on a worker thread (grabbing before verifying and
+	reflecting art), while up to jobs contexts are processed at once."""
+
+	def __init__(self, stages, jobs=1, full=False):
+		self._stages = frozenset(stages)
+		self._jobs = jobs
+		self._full = full
+		self._timer = StageTimer()
+		self._manifests = {}
+		self._kodi = updateKodi.KodiUpdater() if 'kodi' in self._stages else None
+		self._prefetcher = assist.Prefetcher() if 'assist' in self._stages else None
+		self._normalizer = normalizeArt.ArtNormalizer() if 'normalize-art' in self._stages else None
+		self._verifier = verifyArt.ArtVerifier() if 'verify-art' in self._stages else None
+
+	@property
+	def stages(self):
+		return self._stages
+	@property
+	def timer(self):
+		return self._timer
+
+	def _Traverse(self, path):
+		contexts = iter(self._prefetcher.Traverse(path) if self._prefetcher is not None else data.Traverse(path))
+		while True:
+			start = time.monotonic()
+			context = next(contexts, None)
+			if context is None:
+				return
+			self.timer.Add('traverse', time.monotonic() - start)
+			print('Processing:', context)
+			if self._prefetcher is not None:
+				self.timer.Run('assist', assist.PopulateAssist, context, self._prefetcher)
+			yield context
+
+	def _Process(self, context):
+		if 'grab-metadata' in self.stages:
+			self.timer.Run('grab-metadata', grab.GrabMetadata, context)
+		if 'grab-art' in self.stages:
+			self.timer.Run('grab-art', grab.GrabArt, context)
+		if self._normalizer is not None:
+			self.timer.Run('normalize-art', self._normalizer.Normalize, context)
+		if self._verifier is not None:
+			self.timer.Run('verify-art', self._verifier.Submit, context)
+		if 'reflect' in self.stages:
+			self.timer.Run('reflect', mkreflection.ReflectIfChanged, context, self._manifests, self._full)
+		if self._kodi is not None:
+			self.timer.Run('kodi', self._kodi.Update, context)
+
+	def Run(self, paths):
+		if self.stages & frozenset(('assist', 'grab-metadata', 'grab-art')):
+			grab.ConfigureCache(paths)
+		if 'grab-metadata' in self.stages:
+			grab.PrefetchTVDB(paths)
+		succeeded = False
+		try:
+			for path in paths:
+				# Contexts with subcontexts are processed before those are created, as those copy their data.
+				for _ in parallel.OrderedMap(self._Process, self._Traverse(path), self._jobs, sequential=lambda context: context.has_subcontexts, interactive='assist' in self.stages):
+					pass
+			succeeded = True
+		finally:
+			mkreflection.SaveState(self._manifests)
+			if self._kodi is not None:
+				self._kodi.Close(apply=succeeded)
+			if self._normalizer is not None:
+				self._normalizer.Close()
+			if self._prefetcher is not None:
+				self._prefetcher.Close()
+			violations = self._verifier.Finish() if self._verifier is not None else []
+			for violation in violations:
+				print(violation)
+		if violations:
+			raise RuntimeError('%d artwork files are not as expected.' % (len(violations),))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run the maintenance tools over media directories in a single traversal.')
+	parser.add_argument('--stages', default=','.join(DEFAULT_STAGES), help='Comma-separated stages to run, out of: %s.' % (', '.join(STAGES),))
+	parser.add_argument('--jobs', '-j', type=int, default=4, help='Number of contexts to process concurrently.')
+	parser.add_argument('--full', action='store_true', help='Reflect every context, even those unchanged since the last run.')
+	parser.add_argument('paths', nargs='+')
+	args = parser.parse_args()
+	stages = [s for s in args.stages.split(',') if s]
+	for stage in stages:
+		if stage not in STAGES:
+			parser.error('unknown stage %r' % (stage,))
+	start = time.monotonic()
+	pipeline = Pipeline(stages, jobs=args.jobs, full=args.full)
+	try:
+		pipeline.Run(args.paths)
+	finally:
+		httpclient.PrintStats()
+		pipeline.timer.Print(time.monotonic() - start)
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
+import collections
+import concurrent.futures
+import os
 import re
 import sys
 import threading
 import time
 import webbrowser
 import data
+import httpclient
+
+PREFETCH_JOBS = 4
+LOOKAHEAD = 8
 
 def OpenURL(url):
 	webbrowser.open_new_tab(url)
@@ -18,24 +25,110 @@ def Ask(context, prompt, ifEmpty='None'):
 	print('-' * 8)
 	return str(input('%s: %s: ' % (context, prompt)) or ifEmpty)
 
-def EnsureAvailableCallback(context, sourceClass):
+class Prefetcher(object):
+	"""Runs the best match searches and HummingBird ID conversions that prompts need on up to jobs threads, ahead of the prompts.
+
+	Lookups are keyed by source and terms (or MAL ID), so a lookup is only made once, however many contexts need it. Failed lookups are
+	forgotten once they finish, so that contexts needing them later try again."""
+
+	def __init__(self, jobs=PREFETCH_JOBS):
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+		self._lock = threading.Lock()
+		self._futures = {}
+
+	def _Submit(self, key, func, *args):
+		with self._lock:
+			future = self._futures.get(key)
+			if future is not None:
+				return future
+			future = self._futures[key] = self._executor.submit(func, *args)
+		future.add_done_callback(lambda done: self._ForgetFailed(key, done)) # Outside the lock, as it runs at once if already done.
+		return future
+
+	def _ForgetFailed(self, key, future):
+		if future.cancelled() or future.exception() is not None:
+			with self._lock:
+				if self._futures.get(key) is future:
+					del self._futures[key]
+
+	def _BestMatch(self, sourceClass, terms):
+		match = sourceClass.GetBestMatch(terms)
+		if sourceClass is data.MAL and match is not None and str(match).isdigit():
+			self.HummingBirdID(int(match)) # The default is usually accepted, and will need converting.
+		return match
+
+	def BestMatch(self, sourceClass, terms):
+		return self._Submit((sourceClass.KEY, terms), self._BestMatch, sourceClass, terms)
+
+	def HummingBirdID(self, malid):
+		return self._Submit((data.HummingBird.KEY, malid), data.HummingBird.IDFromMALID, malid)
+
+	def Prefetch(self, context):
+		"""Starts the lookups that assisting context will wait on. Returns whether there were any."""
+		started = False
+		for sourceClass in context.id_sources:
+			if not context.GetSource(sourceClass):
+				self.BestMatch(sourceClass, context.name_searchable)
+				started = True
+		if data.MAL in context.id_sources and context.Get(data.MAL.KEY) and not context.Get(data.HummingBird.KEY):
+			self.HummingBirdID(int(context.Get(data.MAL.KEY)))
+			started = True
+		return started
+
+	def _Preview(self, parents, directory, info):
+		"""Starts the lookups of the directory discovered with info, without listing its files. Returns whether there were any."""
+		while len(parents) > 1 and not directory.startswith(parents[-1].path + os.sep):
+			parents.pop()
+		try:
+			context = parents[-1].SubContext(directory, info, check=False)
+			parents.append(context)
+			return self.Prefetch(context)
+		except Exception: # The traversal reports it once it gets there.
+			return False
+
+	def Traverse(self, path, lookahead=LOOKAHEAD):
+		"""Yields the Contexts of data.Traverse(path), having started the lookups of the next lookahead contexts that need any.
+
+		The directories are discovered once. Those ahead are previewed from their .info alone, as their Contexts must not be created before
+		their parents are assisted; a preview predating the prompts for its parents at worst starts a lookup that is never waited on. The
+		yielded Contexts read their .info again (through the InfoCache), as assisting a parent may have written to it since."""
+		path = os.path.abspath(path)
+		discovered = data.Discover(path)
+		buffered = collections.deque() # (directory, info, whether the preview started lookups), not yet traversed.
+		parents = [data.Context(None, path)]
+		def Buffered():
+			while True:
+				while not buffered or (sum(started for _, _, started in buffered) < lookahead and len(buffered) < data.discoveryLookahead):
+					item = next(discovered, None)
+					if item is None:
+						break
+					buffered.append(item + (self._Preview(parents, *item),))
+				if not buffered:
+					return
+				directory, _, _ = buffered.popleft()
+				yield directory, data.readYAML(os.path.join(directory, data.infoFile))
+		for context in data.Traverse(path, Buffered()):
+			self.Prefetch(context) # Also catches contexts previewed before their parents were assisted.
+			yield context
+
+	def Close(self):
+		"""Drops the lookups that have not started; those in progress finish in the background."""
+		self._executor.shutdown(wait=False, cancel_futures=True)
+
+def EnsureAvailableCallback(context, sourceClass, prefetcher):
 	source = context.GetSource(sourceClass)
 	if source:
 		return lambda: None
 	print('%s: Unknown value for "%s". Opening search page.' % (context, sourceClass.KEY))
 	Search(sourceClass, context.name_searchable)
-	default = []
-	def backgroundFetch():
+	future = prefetcher.BestMatch(sourceClass, context.name_searchable)
+	def callback():
 		try:
-			default.append(sourceClass.GetBestMatch(context.name_searchable))
+			default = future.result()
 		except Exception as e:
 			print('Exception while retrieving best match for %s: %s' % (context, e))
-			default.append(None)
-	threading.Thread(target=backgroundFetch).start()
-	def callback():
-		while not default:
-			time.sleep(.1)
-		value = Ask(context, 'Value for "%s" ("None" for None, default="%s")' % (sourceClass.KEY, default[0]), ifEmpty=default[0])
+			default = None
+		value = Ask(context, 'Value for "%s" ("None" for None, default="%s")' % (sourceClass.KEY, default), ifEmpty=default)
 		if value.startswith('http://') or value.startswith('https://'):
 			value = sourceClass.ParseOpenURLToID(sourceClass.CleanURL(value))
 		if value is not None and value.isdigit():
@@ -73,17 +166,17 @@ def PopulateAssistMovieFilename(context):
 	context.kind_data['moviefilename'] = moviefilename
 	context.Overwrite()
 
-def PopulateAssistIDsCallbacks(context):
+def PopulateAssistIDsCallbacks(context, prefetcher):
 	callbacks = []
 	for sourceClass in context.id_sources:
-		callbacks.append(EnsureAvailableCallback(context, sourceClass))
+		callbacks.append(EnsureAvailableCallback(context, sourceClass, prefetcher))
 	return callbacks
 
-def PopulateAssistIDs(context, callbacks):
+def PopulateAssistIDs(context, callbacks, prefetcher):
 	for callback in callbacks:
 		callback()
 	if data.MAL in context.id_sources and context.Get(data.MAL.KEY) and not context.Get(data.HummingBird.KEY):
-		context.kind_data[data.HummingBird.KEY] = data.HummingBird.IDFromMALID(int(context.Get(data.MAL.KEY)))
+		context.kind_data[data.HummingBird.KEY] = prefetcher.HummingBirdID(int(context.Get(data.MAL.KEY))).result()
 	context.Overwrite()
 
 def _ArtNeeded(context, includeSubs=True):
@@ -169,13 +262,22 @@ def PopulateAssistArt(context):
 			c.kind_data[art] = url
 		c.Overwrite()
 
+def PopulateAssist(context, prefetcher):
+	callbacks = PopulateAssistIDsCallbacks(context, prefetcher)
+	PopulateAssistSeasonNumber(context)
+	PopulateAssistMovieFilename(context)
+	PopulateAssistIDs(context, callbacks, prefetcher)
+	PopulateGatherArt(context)
+	PopulateAssistArt(context)
+
 if __name__ == '__main__':
-	for path in sys.argv[1:]:
-		for context in data.Traverse(path):
-			print('Processing:', context)
-			callbacks = PopulateAssistIDsCallbacks(context)
-			PopulateAssistSeasonNumber(context)
-			PopulateAssistMovieFilename(context)
-			PopulateAssistIDs(context, callbacks)
-			PopulateGatherArt(context)
-			PopulateAssistArt(context)
+	data.configureCaches(sys.argv[1:]) # Keeps the best matches of searches between sessions.
+	prefetcher = Prefetcher()
+	try:
+		for path in sys.argv[1:]:
+			for context in prefetcher.Traverse(path):
+				print('Processing:', context)
+				PopulateAssist(context, prefetcher)
+	finally:
+		prefetcher.Close()
+	httpclient.PrintStats()
@@ -0,0 +1,33 @@
+import unittest
+import data
+
+class GuessEpisodeNumbersTest(unittest.TestCase):
+	"""GuessEpisodeNumbers must agree with GuessEpisodeNumber on every file of a season."""
+
+	def assertGuesses(self, filenames, expected):
+		guesses = data.Episode.GuessEpisodeNumbers(filenames)
+		self.assertEqual([guesses[f] for f in filenames], expected)
+		self.assertEqual(guesses, {f: data.Episode.GuessEpisodeNumber(f) for f in filenames})
+
+	def testReleaseNames(self):
+		filenames = ['[Group] Show S2 - %02d (BD 1080p x264 10-bit) [%08X].mkv' % (i, i * 7919) for i in range(1, 13)]
+		self.assertGuesses(filenames, list(range(1, 13)))
+
+	def testAbsoluteNumberBeforeSeasonEpisode(self):
+		filenames = ['Show - %02d (S02E%02d) [720p].mkv' % (12 + i, i) for i in range(1, 13)]
+		self.assertGuesses(filenames, list(range(1, 13)))
+
+	def testLaterNumberInTitle(self):
+		filenames = ['Show - 01 - Pilot.mkv', 'Show - 02 - Second.mkv', 'Show - 03 - The 100 Days.mkv', 'Show - 04 - Fourth.mkv']
+		self.assertGuesses(filenames, [1, 2, 100, 4])
+
+	def testLaterBracketedNumber(self):
+		filenames = ['[G] Show - 01 [1080p][49].mkv', '[G] Show - 02 [1080p][50].mkv', '[G] Show - 03 [1080p][51].mkv']
+		self.assertGuesses(filenames, [49, 50, 51])
+
+	def testDateStampedNames(self):
+		filenames = ['Show - 2019-05-%02d - %02d.mkv' % (5 + 7 * i, i + 1) for i in range(4)]
+		self.assertGuesses(filenames, [1, 2, 3, 4])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,183 @@
+import concurrent.futures
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import webcache
+
+# TVDB API, imported on first fetch.
+sys.path.append(os.path.join(os.path.dirname(__file__), 'submodules/tvdb_api'))
+
+# Shows fetched longer ago than this are refetched. Episode lists of airing shows change, so this is shorter than the HTTP cache TTL.
+STALE_AFTER = 7 * 24 * 3600
+PREFETCH_JOBS = 8
+cacheFile = 'tvdb-shows.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shows (
+	id INTEGER PRIMARY KEY,
+	version INTEGER NOT NULL,
+	record TEXT NOT NULL,
+	fetched REAL NOT NULL
+);
+"""
+
+class Show(dict):
+	"""A TVDB series record: a dict of season number to a dict of episode number to episode record, with the series fields in data."""
+
+	def __init__(self, id, data, seasons):
+		super(Show, self).__init__(seasons)
+		self._id = id
+		self._data = data
+
+	@property
+	def id(self):
+		return self._id
+	@property
+	def data(self):
+		return self._data
+
+	def Serialize(self):
+		return json.dumps({
+			'data': self.data,
+			'seasons': {s: {e: episode for e, episode in season.items()} for s, season in self.items()},
+		}, default=str, sort_keys=True)
+
+	@classmethod
+	def Deserialize(cls, id, serialized):
+		record = json.loads(serialized)
+		seasons = {int(s): {int(e): episode for e, episode in season.items()} for s, season in record['seasons'].items()}
+		return cls(id, record['data'], seasons)
+
+	def __str__(self):
+		return 'Show<%d>' % (self.id,)
+
+_clients = threading.local()
+
+def _Fetch(id):
+	"""Fetches a show with this thread's own tvdb_api client, as those are not safe to share between threads."""
+	client = getattr(_clients, 'client', None)
+	if client is None:
+		import tvdb_api
+		client = _clients.client = tvdb_api.Tvdb(language='en')
+	show = client[id]
+	seasons = {int(s): {int(e): dict(episode) for e, episode in season.items()} for s, season in show.items()}
+	return Show(id, dict(show.data), seasons)
+
+class ShowCache(object):
+	"""Keeps TVDB series records in an SQLite database (in memory if path is None), refetching them once they are STALE_AFTER old.
+
+	Records written by another VERSION of this cache are ignored. In offline mode, stale records are returned as they are, and missing
+	ones raise webcache.OfflineError."""
+
+	VERSION = 1
+
+	def __init__(self, path=None, offline=False, fetch=_Fetch):
+		self._path = path
+		self._offline = offline
+		self._fetch = fetch
+		self._lock = threading.Lock()
+		self._shows = {}
+		self._coalescer = webcache.Coalescer()
+		self._conn = sqlite3.connect(path or ':memory:', check_same_thread=False)
+		self._conn.executescript(_SCHEMA)
+		self._conn.commit()
+
+	@property
+	def path(self):
+		return self._path
+	@property
+	def offline(self):
+		return self._offline
+
+	def _Lookup(self, id):
+		"""Returns (show, fetched) for id from memory or the database, or (None, None)."""
+		with self._lock:
+			if id in self._shows:
+				return self._shows[id]
+			row = self._conn.execute('SELECT record, fetched FROM shows WHERE id = ? AND version = ?', (id, self.VERSION)).fetchone()
+		if row is None:
+			return None, None
+		entry = (Show.Deserialize(id, row[0]), row[1])
+		with self._lock:
+			return self._shows.setdefault(id, entry)
+
+	def _Store(self, show):
+		now = time.time()
+		serialized = show.Serialize()
+		with self._lock:
+			self._shows[show.id] = (show, now)
+			self._conn.execute('INSERT OR REPLACE INTO shows (id, version, record, fetched) VALUES (?, ?, ?, ?)', (show.id, self.VERSION, serialized, now))
+			self._conn.commit()
+
+	def IsFresh(self, id):
+		_, fetched = self._Lookup(int(id))
+		return fetched is not None and (self.offline or fetched + STALE_AFTER >= time.time())
+
+	def Get(self, id):
+		id = int(id)
+		show, fetched = self._Lookup(id)
+		if show is not None and (self.offline or fetched + STALE_AFTER >= time.time()):
+			return show
+		if self.offline:
+			raise webcache.OfflineError('Offline mode: no cached TVDB record for show %d' % (id,))
+		return self._coalescer.Call(id, lambda: self._FetchAndStore(id))
+
+	def _FetchAndStore(self, id):
+		show = self._fetch(id)
+		self._Store(show)
+		return show
+
+	def Prefetch(self, ids, jobs=PREFETCH_JOBS):
+		"""Fetches the shows among ids that are missing or stale on up to jobs threads. Returns the numbers of shows fetched and of failures.
+
+		Failures are reported as warnings, leaving the show to be fetched (and fail loudly) when it is actually used."""
+		missing = sorted(frozenset(int(id) for id in ids if not self.IsFresh(id)))
+		if not missing or self.offline:
+			return 0, 0
+		failed = 0
+		with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+			futures = {executor.submit(self.Get, id): id for id in missing}
+			for future in concurrent.futures.as_completed(futures):
+				try:
+					future.result()
+				except Exception as e:
+					print('Warning: Could not prefetch TVDB show %d: %s' % (futures[future], e))
+					failed += 1
+		return len(missing) - failed, failed
+
+	def Close(self):
+		with self._lock:
+			self._conn.close()
+
+	def __str__(self):
+		return 'ShowCache<%s>' % (self.path or ':memory:',)
+
+_cache = None
+_cacheLock = threading.Lock()
+
+def Configure(path=None, offline=False):
+	"""Sets up the process-wide cache used by Get and Prefetch. Without a path, shows are only cached in memory for the run."""
+	global _cache
+	with _cacheLock:
+		if _cache is not None:
+			_cache.Close()
+		_cache = ShowCache(path, offline=offline)
+	return _cache
+
+def Cache():
+	"""Returns the process-wide cache, setting up an in-memory one if Configure was never called."""
+	global _cache
+	with _cacheLock:
+		if _cache is None:
+			_cache = ShowCache()
+		return _cache
+
+def Get(id):
+	return Cache().Get(id)
+
+def Prefetch(ids, jobs=PREFETCH_JOBS):
+	return Cache().Prefetch(ids, jobs=jobs)
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
+import argparse
 import os
-import sys
 import sqlite3
+import threading
 import xml.etree.ElementTree as ET
 import data
 
@@ -22,7 +23,7 @@ _sortOrder = 1 # Ascending
 _sortAttributes = 0 # Nothing special
 _skin = 'skin.aeon.nox.5' # Aeon nox
 
-_querySelect = 'SELECT idView, window, viewMode, sortMethod, sortOrder, sortAttributes, skin FROM view WHERE path = ?'
+_querySelect = 'SELECT idView, path, window, viewMode, sortMethod, sortOrder, sortAttributes, skin FROM view ORDER BY idView'
 _queryInsert = 'INSERT INTO view (window, path, viewMode, sortMethod, sortOrder, sortAttributes, skin) VALUES(%d, ?, ?, %d, %d, %d, %r)' % (_window, _sortMethod, _sortOrder, _sortAttributes, _skin)
 _queryUpdate = 'UPDATE view SET viewMode = ?, sortMethod = %d, sortOrder = %d, sortAttributes = %d WHERE idView = ?' % (_sortMethod, _sortOrder, _sortAttributes)
 
@@ -33,63 +34,153 @@ _backgroundKeys = (
 	'skin.aeon.nox.5.Videos.Fallback',
 )
 
-def _RunQuery(cursor, query, parameters):
-	print('Running query: %r with parameters %r' % (query, parameters))
-	cursor.execute(query, parameters)
-
-def UpdateDatabase(context, cursor):
+def DesiredView(context):
+	"""Returns the Kodi view path of context and the view mode it should have, or None if it has no preference."""
 	mode = _viewMode_mapping.get(context.kind)
 	if not mode:
-		return
+		return None
 	reflected_path = context.reflected_path
 	if not reflected_path.endswith(os.sep):
 		reflected_path += os.sep
-	row = cursor.execute(_querySelect, (reflected_path,)).fetchone()
-	if row:
-		idView, window, viewMode, sortMethod, sortOrder, sortAttributes, skin = row
-		if (window, viewMode, sortMethod, sortOrder, sortAttributes, skin) != (_window, mode, _sortMethod, _sortOrder, _sortAttributes, _skin):
-			_RunQuery(cursor, _queryUpdate, (mode, idView))
-	else:
-		_RunQuery(cursor, _queryInsert, (reflected_path, mode))
-
-def UpdateKodiProfile(library, profile):
+	return reflected_path, mode
+
+class ViewTable(object):
+	"""The view table of a Kodi profile, loaded once into a dict by path. Changes are collected in memory and written in one transaction."""
+
+	def __init__(self, database):
+		self._database = database
+		self._views = {}
+		self._inserts = []
+		self._updates = []
+		conn = sqlite3.connect(database)
+		try:
+			for idView, path, window, viewMode, sortMethod, sortOrder, sortAttributes, skin in conn.execute(_querySelect):
+				self._views.setdefault(path, (idView, (window, viewMode, sortMethod, sortOrder, sortAttributes, skin)))
+		finally:
+			conn.close()
+
+	@property
+	def database(self):
+		return self._database
+	@property
+	def changes(self):
+		return len(self._inserts) + len(self._updates)
+
+	def Plan(self, path, mode):
+		"""Records the change, if any, needed to give path the view mode."""
+		wanted = (_window, mode, _sortMethod, _sortOrder, _sortAttributes, _skin)
+		view = self._views.get(path)
+		if view is None:
+			self._inserts.append((path, mode))
+		elif view[1] != wanted:
+			self._updates.append((path, view[1][1], mode, view[0]))
+		else:
+			return
+		self._views[path] = (view[0] if view else None, wanted)
+
+	def PrintDiff(self):
+		for path, mode in self._inserts:
+			print('+ %s: viewMode %d' % (path, mode))
+		for path, oldMode, mode, _ in self._updates:
+			print('~ %s: viewMode %d -> %d' % (path, oldMode, mode))
+
+	def Apply(self):
+		"""Writes the planned changes in a single transaction."""
+		if not self.changes:
+			return
+		conn = sqlite3.connect(self.database, isolation_level=None)
+		try:
+			conn.execute('BEGIN IMMEDIATE')
+			try:
+				conn.executemany(_queryInsert, self._inserts)
+				conn.executemany(_queryUpdate, ((mode, idView) for _, _, mode, idView in self._updates))
+			except BaseException:
+				conn.execute('ROLLBACK')
+				raise
+			conn.execute('COMMIT')
+		finally:
+			conn.close()
+		self._inserts = []
+		self._updates = []
+
+	def __str__(self):
+		return 'ViewTable<%s>' % (self.database,)
+
+def UpdateDatabase(context, views):
+	view = DesiredView(context)
+	if view is not None:
+		views.Plan(*view)
+
+def UpdateKodiProfile(library, profile, dryRun=False):
 	guisettings = os.path.join(profile, 'userdata/guisettings.xml')
 	tree = ET.parse(guisettings)
 	changed = False
 	for setting in tree.getroot().findall('.//setting'):
 		if setting.get('name') in _backgroundKeys and setting.text != library.background:
 			changed = True
+			if dryRun:
+				print('~ %s: %s: %r -> %r' % (guisettings, setting.get('name'), setting.text, library.background))
 			setting.text = library.background
-	if changed:
+	if changed and not dryRun:
 		tree.write(guisettings)
 
-if __name__ == '__main__':
-	libraries = {}
-	databases = {}
-	try:
-		for path in sys.argv[1:]:
-			for context in data.Traverse(path):
-				print('Updating database entry for:', context)
-				library = context.library
-				if library.path not in libraries:
-					libraries[library.path] = library
-					for profile in library.kodi_profiles:
-						if profile in databases:
-							continue
-						database = os.path.join(profile, 'userdata/Database/ViewModes6.db')
-						if not os.path.isfile(database):
-							raise RuntimeError('Database file %r does not exist.' % (database,))
-						conn = sqlite3.connect(database)
-						cursor = conn.cursor()
-						databases[profile] = (conn, cursor)
-				for profile in library.kodi_profiles:
-					UpdateDatabase(context, databases[profile][1])
-	finally:
-		for conn, _ in databases.values():
-			conn.commit()
-			conn.close()
-	for library in libraries.values():
-		print('Updating library settings for:', library)
+class KodiUpdater(object):
+	"""Plans the view modes of contexts in the Kodi profiles of their libraries. On Close, writes them along with the library settings of
+	those profiles, or only prints them in dry-run mode."""
+
+	def __init__(self, dryRun=False):
+		self._dryRun = dryRun
+		self._lock = threading.Lock()
+		self._libraries = {}
+		self._views = {}
+
+	@property
+	def dry_run(self):
+		return self._dryRun
+
+	def _Open(self, library):
+		if library.path in self._libraries:
+			return
+		self._libraries[library.path] = library
 		for profile in library.kodi_profiles:
-			print('Updating Kodi profile for', library, 'at', profile)
-			UpdateKodiProfile(library, profile)
+			if profile in self._views:
+				continue
+			database = os.path.join(profile, 'userdata/Database/ViewModes6.db')
+			if not os.path.isfile(database):
+				raise RuntimeError('Database file %r does not exist.' % (database,))
+			self._views[profile] = ViewTable(database)
+
+	def Update(self, context):
+		print('Updating database entry for:', context)
+		library = context.library
+		with self._lock:
+			self._Open(library)
+			for profile in library.kodi_profiles:
+				UpdateDatabase(context, self._views[profile])
+
+	def Close(self, apply=True):
+		"""Applies (or prints, in dry-run mode) the planned changes. Nothing is written if apply is false, e.g. after an error."""
+		if not apply:
+			return
+		with self._lock:
+			for profile, views in sorted(self._views.items()):
+				print('%s %d view changes for profile %s' % ('Would make' if self.dry_run else 'Making', views.changes, profile))
+				views.PrintDiff()
+				if not self.dry_run:
+					views.Apply()
+		for library in self._libraries.values():
+			print('Updating library settings for:', library)
+			for profile in library.kodi_profiles:
+				print('Updating Kodi profile for', library, 'at', profile)
+				UpdateKodiProfile(library, profile, dryRun=self.dry_run)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Set Kodi view modes and library settings for media directories.')
+	parser.add_argument('--dry-run', action='store_true', help='Only print the changes that would be made.')
+	parser.add_argument('paths', nargs='+')
+	args = parser.parse_args()
+	updater = KodiUpdater(dryRun=args.dry_run)
+	for path in args.paths:
+		for context in data.Traverse(path):
+			updater.Update(context)
+	updater.Close()
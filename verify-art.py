@@ -1,32 +1,139 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import os
+import struct
 import sys
-from PIL import Image
+import threading
 import data
 
+sizeCacheFile = 'art-sizes.json'
+VERIFY_JOBS = 8
+
 _expectedRatios = {
 	'banner': lambda r: r > 3.0,
 	'background': lambda r: r < 2.0,
 	'poster': lambda r: r < 1.0,
 }
+# Start of frame markers, which hold the image dimensions. The others in the range are DHT (c4), JPG (c8) and DAC (cc).
+_JPEG_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset((0xc4, 0xc8, 0xcc))
+# Markers without a length field: TEM, RSTn and SOI.
+_JPEG_STANDALONE_MARKERS = frozenset([0x01, 0xd8] + list(range(0xd0, 0xd8)))
 
-def _VerifyFile(context, art, path):
-	comparison = _expectedRatios[art]
-	width, height = Image.open(path).size
-	ratio = float(width) / float(height)
-	if not comparison(ratio):
-		raise RuntimeError('%s: Artwork for %s has ratio %0.2f (%dx%d): %s' % (context, art, ratio, width, height, path))
+def _JPEGSize(f):
+	"""Returns (width, height) from the first frame header of the JPEG file f, positioned after its SOI marker, or None if it has none.
+
+	Segments before the frame header (such as EXIF thumbnails) are skipped over rather than read."""
+	while True:
+		if f.read(1) != b'\xff':
+			return None
+		marker = f.read(1)
+		while marker == b'\xff': # Fill bytes.
+			marker = f.read(1)
+		if not marker:
+			return None
+		marker = marker[0]
+		if marker in _JPEG_STANDALONE_MARKERS:
+			continue
+		if marker in (0xd9, 0xda): # End of image, or start of scan without a frame header.
+			return None
+		length = f.read(2)
+		if len(length) < 2:
+			return None
+		length, = struct.unpack('>H', length)
+		if marker in _JPEG_SOF_MARKERS:
+			header = f.read(5)
+			if len(header) < 5:
+				return None
+			height, width = struct.unpack('>xHH', header)
+			return width, height
+		f.seek(length - 2, os.SEEK_CUR)
+
+def ImageSize(path):
+	"""Returns the (width, height) of the image at path, read from its headers for PNG and JPEG files."""
+	with open(path, 'rb') as f:
+		head = f.read(24)
+		extension = data.sniffImageExtension(head)
+		if extension == 'png' and head[12:16] == b'IHDR':
+			return struct.unpack('>II', head[16:24])
+		if extension == 'jpg':
+			f.seek(2)
+			size = _JPEGSize(f)
+			if size is not None:
+				return size
+	from PIL import Image # Only needed for other formats, and slow to import.
+	with Image.open(path) as image:
+		return image.size
+
+class ArtSizeCache(data.SidecarCache):
+	"""Dimensions of art files keyed by path and validated by size and mtime, so that unchanged files are never opened again. Without a
+	path, sizes are only cached in memory for the run."""
+
+	FILENAME = sizeCacheFile
+	VERSION = 2
+
+	def Size(self, art_path):
+		return tuple(self._Validated(art_path, ImageSize))
 
-def VerifyArt(context):
+def ArtFiles(context):
+	"""Yields (art, path) for each art file of context."""
+	files = frozenset(context.filenames)
 	for art in context.expected_art:
 		for ext in data.imageExtensions:
-			path = os.path.join(context.path, data.artResourceFilenames[art] + '.' + ext)
-			if os.path.exists(path):
-				_VerifyFile(context, art, path)
+			filename = data.artResourceFilenames[art] + '.' + ext
+			if filename in files:
+				yield art, os.path.join(context.path, filename)
+
+def _VerifyFile(cache, context, art, path):
+	"""Returns a description of what is wrong with the art file at path, or None if its ratio is as expected."""
+	try:
+		width, height = cache.Size(path)
+	except Exception as e:
+		return '%s: Cannot read artwork for %s: %s: %s' % (context, art, path, e)
+	ratio = float(width) / float(height)
+	if not _expectedRatios[art](ratio):
+		return '%s: Artwork for %s has ratio %0.2f (%dx%d): %s' % (context, art, ratio, width, height, path)
+	return None
+
+class ArtVerifier(object):
+	"""Checks the ratio of the art of contexts on up to jobs threads, and collects every violation to be reported once all are checked."""
+
+	def __init__(self, jobs=VERIFY_JOBS):
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+		self._lock = threading.Lock()
+		self._caches = set()
+		self._futures = []
+
+	def _CacheFor(self, context):
+		"""Returns the size cache of the library context is in, or one kept in memory if it is not in a library."""
+		cache = ArtSizeCache.ForRoot(data.findRoot(context.path))
+		with self._lock:
+			self._caches.add(cache)
+		return cache
+
+	def Submit(self, context):
+		cache = self._CacheFor(context)
+		futures = [self._executor.submit(_VerifyFile, cache, context, art, path) for art, path in ArtFiles(context)]
+		with self._lock:
+			self._futures.extend(futures)
+
+	def Finish(self):
+		"""Waits for all submitted files to be checked and saves the size caches. Returns the violations, in the order contexts were submitted."""
+		self._executor.shutdown(wait=True)
+		for cache in self._caches:
+			cache.Save()
+		return [violation for violation in (future.result() for future in self._futures) if violation is not None]
 
 if __name__ == '__main__':
-	for path in sys.argv[1:]:
-		for context in data.Traverse(path):
-			print('Verifying:', context)
-			VerifyArt(context)
+	verifier = ArtVerifier()
+	try:
+		for path in sys.argv[1:]:
+			for context in data.Traverse(path):
+				print('Verifying:', context)
+				verifier.Submit(context)
+	finally:
+		violations = verifier.Finish()
+	for violation in violations:
+		print(violation)
+	if violations:
+		sys.exit('%d artwork files are not as expected.' % (len(violations),))
@@ -0,0 +1,231 @@
+import concurrent.futures
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import httpclient
+
+# How long a cached response stays fresh, in seconds, by Source.KEY. None applies to requests made on behalf of no particular source.
+TTLS = {
+	'tvdb': 30 * 24 * 3600,
+	'hummingbird': 7 * 24 * 3600,
+	'mal': 7 * 24 * 3600,
+	None: 24 * 3600,
+}
+# How long the best match of a search stays fresh, in seconds. Search results change far less often than the pages they lead to.
+SEARCH_TTL = 14 * 24 * 3600
+MAX_BYTES = 256 * 1024 * 1024
+cacheFile = 'http-cache.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+	key TEXT PRIMARY KEY,
+	url TEXT NOT NULL,
+	source TEXT,
+	status INTEGER NOT NULL,
+	headers TEXT NOT NULL,
+	content BLOB NOT NULL,
+	size INTEGER NOT NULL,
+	fetched REAL NOT NULL,
+	accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+CREATE TABLE IF NOT EXISTS searches (
+	source TEXT NOT NULL,
+	terms TEXT NOT NULL,
+	result TEXT NOT NULL,
+	fetched REAL NOT NULL,
+	PRIMARY KEY (source, terms)
+);
+"""
+
+class OfflineError(RuntimeError):
+	pass
+
+class Coalescer(object):
+	"""Runs at most one call per key at a time: a call for a key already in flight waits for it, and shares its result or exception."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._inflight = {}
+
+	def Call(self, key, function):
+		with self._lock:
+			future = self._inflight.get(key)
+			owner = future is None
+			if owner:
+				future = self._inflight[key] = concurrent.futures.Future()
+		if not owner:
+			return future.result()
+		try:
+			result = function()
+			future.set_result(result)
+			return result
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		finally:
+			with self._lock:
+				del self._inflight[key]
+
+class Response(object):
+	"""The parts of a requests.Response that callers use, in a form that can be stored and replayed."""
+
+	def __init__(self, url, status_code, headers, content):
+		self._url = url
+		self._status_code = status_code
+		self._headers = headers
+		self._content = content
+
+	@property
+	def url(self):
+		return self._url
+	@property
+	def status_code(self):
+		return self._status_code
+	@property
+	def headers(self):
+		return self._headers
+	@property
+	def content(self):
+		return self._content
+	@property
+	def text(self):
+		return self._content.decode('utf-8', 'replace')
+
+	def json(self):
+		return json.loads(self.text)
+
+	def __str__(self):
+		return 'Response<%d %s>' % (self.status_code, self.url)
+
+def _Fetch(url, headers, source):
+	response = httpclient.Get(url, source=source, headers=headers)
+	return Response(url, response.status_code, dict(response.headers), response.content)
+
+class ResponseCache(object):
+	"""Caches successful GET responses by URL and request headers, and the best matches of searches by source and terms, in an SQLite
+	database (in memory if path is None).
+
+	Concurrent requests for the same key are coalesced into a single fetch. In offline mode, any cached response is returned regardless of
+	its age, and missing ones raise OfflineError instead of hitting the network."""
+
+	def __init__(self, path=None, offline=False, max_bytes=MAX_BYTES, fetch=_Fetch):
+		self._path = path
+		self._offline = offline
+		self._max_bytes = max_bytes
+		self._fetch = fetch
+		self._lock = threading.Lock()
+		self._coalescer = Coalescer()
+		self._conn = sqlite3.connect(path or ':memory:', check_same_thread=False)
+		self._conn.executescript(_SCHEMA)
+		self._conn.commit()
+
+	@property
+	def path(self):
+		return self._path
+	@property
+	def offline(self):
+		return self._offline
+
+	@staticmethod
+	def _Key(url, headers):
+		return hashlib.sha256(json.dumps([url, sorted((headers or {}).items())]).encode('utf-8')).hexdigest()
+
+	def _Lookup(self, key, ttl):
+		with self._lock:
+			row = self._conn.execute('SELECT url, status, headers, content, fetched FROM responses WHERE key = ?', (key,)).fetchone()
+			if row is None:
+				return None
+			url, status, headers, content, fetched = row
+			if not self.offline and fetched + ttl < time.time():
+				return None
+			self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+			self._conn.commit()
+		return Response(url, status, json.loads(headers), content)
+
+	def _Store(self, key, source, response):
+		now = time.time()
+		with self._lock:
+			self._conn.execute('INSERT OR REPLACE INTO responses (key, url, source, status, headers, content, size, fetched, accessed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+				key, response.url, source, response.status_code, json.dumps(response.headers), response.content, len(response.content), now, now,
+			))
+			total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+			if total > self._max_bytes:
+				for evictKey, size in self._conn.execute('SELECT key, size FROM responses ORDER BY accessed ASC').fetchall():
+					if total <= self._max_bytes:
+						break
+					self._conn.execute('DELETE FROM responses WHERE key = ?', (evictKey,))
+					total -= size
+			self._conn.commit()
+
+	def _FetchAndStore(self, key, url, headers, source):
+		response = self._fetch(url, headers, source)
+		if response.status_code == 200:
+			self._Store(key, source, response)
+		return response
+
+	def Get(self, url, headers=None, source=None):
+		key = self._Key(url, headers)
+		response = self._Lookup(key, TTLS.get(source, TTLS[None]))
+		if response is not None:
+			return response
+		if self.offline:
+			raise OfflineError('Offline mode: no cached response for %s' % (url,))
+		return self._coalescer.Call(key, lambda: self._FetchAndStore(key, url, headers, source))
+
+	def _FetchAndStoreSearch(self, source, terms, search):
+		result = search()
+		with self._lock:
+			self._conn.execute('INSERT OR REPLACE INTO searches (source, terms, result, fetched) VALUES (?, ?, ?, ?)', (source, terms, json.dumps(result), time.time()))
+			self._conn.commit()
+		return result
+
+	def Search(self, source, terms, search):
+		"""Returns the best match for terms on source, calling search() to find it if none was stored in the last SEARCH_TTL.
+
+		Finding no match is a result too, so it is cached likewise. Failed searches raise, and are not cached."""
+		with self._lock:
+			row = self._conn.execute('SELECT result, fetched FROM searches WHERE source = ? AND terms = ?', (source, terms)).fetchone()
+		if row is not None and (self.offline or row[1] + SEARCH_TTL >= time.time()):
+			return json.loads(row[0])
+		if self.offline:
+			raise OfflineError('Offline mode: no cached %s search for %r' % (source, terms))
+		return self._coalescer.Call(('search', source, terms), lambda: self._FetchAndStoreSearch(source, terms, search))
+
+	def Close(self):
+		with self._lock:
+			self._conn.close()
+
+	def __str__(self):
+		return 'ResponseCache<%s>' % (self.path or ':memory:',)
+
+_cache = None
+_cacheLock = threading.Lock()
+
+def Configure(path=None, offline=False):
+	"""Sets up the process-wide cache used by Get. Without a path, responses are only cached in memory for the run."""
+	global _cache
+	with _cacheLock:
+		if _cache is not None:
+			_cache.Close()
+		_cache = ResponseCache(path, offline=offline)
+	return _cache
+
+def Cache():
+	"""Returns the process-wide cache, setting up an in-memory one if Configure was never called."""
+	global _cache
+	with _cacheLock:
+		if _cache is None:
+			_cache = ResponseCache()
+		return _cache
+
+def Get(url, headers=None, source=None):
+	"""GETs url through the process-wide cache."""
+	return Cache().Get(url, headers=headers, source=source)
+
+def Search(source, terms, search):
+	"""Returns the best match for terms on source through the process-wide cache, calling search() if it has none."""
+	return Cache().Search(source, terms, search)